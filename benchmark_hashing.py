@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from file_hashing import get_crc32, get_sha256, hash_files
+import os
+import sys
+import time
+
+# Measure hashing throughput for the files underneath a folder with an
+# increasing number of workers, for example:
+#
+#   python benchmark_hashing.py /home/me/dev/translate-learn/learn.liferay.com
+
+
+def get_file_paths(folder):
+    file_paths = []
+
+    for parent, _, file_names in os.walk(folder):
+        file_paths.extend([os.path.join(parent, file_name) for file_name in file_names])
+
+    return file_paths
+
+
+def get_worker_counts():
+    cpu_count = os.cpu_count() or 1
+    worker_counts = []
+
+    worker_count = 1
+
+    while worker_count < cpu_count:
+        worker_counts.append(worker_count)
+        worker_count = worker_count * 2
+
+    worker_counts.append(cpu_count)
+
+    return worker_counts
+
+
+def benchmark(file_paths, digest, workers):
+    start_time = time.perf_counter()
+    hash_files(file_paths, digest, False, workers)
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+
+    file_paths = get_file_paths(folder)
+    total_size = sum([os.path.getsize(file_path) for file_path in file_paths])
+
+    print(
+        "%d files, %.1f MB in %s" % (len(file_paths), total_size / 1048576, folder)
+    )
+
+    # Read everything once so that every run works from the page cache
+
+    hash_files(file_paths)
+
+    for digest_name, digest in [("crc32", get_crc32), ("sha256", get_sha256)]:
+        for workers in get_worker_counts():
+            elapsed = benchmark(file_paths, digest, workers)
+
+            print(
+                "%-6s %3d workers: %10.1f files/s %10.1f MB/s"
+                % (
+                    digest_name,
+                    workers,
+                    len(file_paths) / elapsed,
+                    total_size / 1048576 / elapsed,
+                )
+            )
@@ -1,57 +1,64 @@
-from crowdin_check import hide_code_translations
+import asyncio
+from bs4 import BeautifulSoup
+from crowdin_async import (
+    crowdin_poll,
+    crowdin_poll_async,
+    crowdin_request_async,
+    run_async,
+    run_async_all,
+    upload_file_to_crowdin_storage_async,
+)
+from crowdin_check import hide_code_translations_async
+import crowdin_state
 from crowdin_util import (
     crowdin_request,
     get_crowdin_file_info,
+    get_crowdin_session,
     get_directory,
+    get_file_progress,
     get_repository_state,
-    upload_file_to_crowdin_storage,
+    invalidate_crowdin_file_info,
 )
 from datetime import datetime, timedelta
+from file_hashing import (
+    get_semantic_hash,
+    get_sha256,
+    hash_file,
+    hash_files,
+    is_semantic_hashing_enabled,
+)
+import hash_manifest
+from http_retry import get_timeout, send_request
 import logging
 import os
-import requests
-import time
+import tempfile
+import translation_memory
 from zipfile import ZipFile
+import zlib
 
 # Wrapper functions to upload sources and download translations.
 
 
 def crowdin_download_translations(
-    repository, source_language, target_language, file_info
+    repository, source_language, target_language, file_info, *, reuse_recent_build=True
 ):
     source_language = source_language[:2]
     target_language = target_language[:2]
 
-    api_path = "/projects/%s/directories" % repository.project_id
-
-    status_code, response_data = crowdin_request(api_path, "GET", {})
+    dest_directory = get_directory(repository, "", False)
 
-    dest_directories = [
-        directory["data"]
-        for directory in response_data
-        if directory["data"]["name"] == repository.dest_folder
-    ]
-
-    if len(dest_directories) != 1:
+    if dest_directory is None:
         logging.info("Unable to find data directory %s" % repository.dest_folder)
         return
 
-    dest_directory_id = dest_directories[0]["id"]
-
-    def get_recent_build(build_id):
-        if build_id is not None:
-            api_path = "/projects/%s/translations/builds/%s" % (
-                repository.project_id,
-                build_id,
-            )
-
-            status_code, response_data = crowdin_request(api_path, "GET", {})
-
-            if status_code == 200:
-                build_id = response_data["id"]
+    if os.getenv("crowdin_download_mode", "build") == "files" and file_info:
+        return crowdin_download_changed_files(
+            repository, source_language, target_language, file_info
+        )
 
-                return response_data
+    dest_directory_id = dest_directory["id"]
 
+    def get_recent_build():
         api_path = "/projects/%s/translations/builds" % repository.project_id
 
         logging.info("Retrieving build list...")
@@ -61,6 +68,7 @@ def crowdin_download_translations(
             if (
                 "directoryId" not in build["data"]
                 or build["data"]["directoryId"] != dest_directory_id
+                or build["data"]["status"] in ["failed", "canceled"]
             ):
                 continue
 
@@ -76,9 +84,7 @@ def crowdin_download_translations(
 
         return None
 
-    recent_build = get_recent_build(None)
-
-    if recent_build is None:
+    def start_build():
         api_path = "/projects/%s/translations/builds/directories/%s" % (
             repository.project_id,
             dest_directory_id,
@@ -87,12 +93,39 @@ def crowdin_download_translations(
         data = {"targetLanguageIds": [source_language, target_language]}
 
         status_code, response_data = crowdin_request(api_path, "POST", data)
-        recent_build = response_data
 
-    while recent_build["status"] != "finished":
-        logging.info("Waiting for build to finish...")
-        time.sleep(15)
-        recent_build = get_recent_build(recent_build["id"])
+        if response_data is None:
+            raise Exception("Unable to start build (HTTP %d)" % status_code)
+
+        return response_data
+
+    def wait_for_build(build):
+        build_api_path = "/projects/%s/translations/builds/%s" % (
+            repository.project_id,
+            build["id"],
+        )
+
+        return crowdin_poll(build_api_path, build, "build")
+
+    recent_build = get_recent_build() if reuse_recent_build else None
+
+    if recent_build is None:
+        recent_build = wait_for_build(start_build())
+    else:
+        recent_build = wait_for_build(recent_build)
+
+        if recent_build["status"] != "finished":
+            logging.warning(
+                "Build %s was %s, starting a new build"
+                % (recent_build["id"], recent_build["status"])
+            )
+
+            recent_build = wait_for_build(start_build())
+
+    if recent_build["status"] != "finished":
+        raise Exception(
+            "Build %s was %s" % (recent_build["id"], recent_build["status"])
+        )
 
     api_path = "/projects/%s/translations/builds/%s/download" % (
         repository.project_id,
@@ -101,87 +134,575 @@ def crowdin_download_translations(
 
     status_code, response_data = crowdin_request(api_path, "GET", {})
 
-    r = requests.get(response_data["url"])
+    if response_data is None:
+        raise Exception(
+            "Unable to download build %s (HTTP %d)" % (recent_build["id"], status_code)
+        )
+
+    r = send_request(
+        response_data["url"],
+        lambda: get_crowdin_session().get(
+            response_data["url"], stream=True, timeout=get_timeout()
+        ),
+    )
 
-    export_file_name = "export-%f.zip" % datetime.utcnow().timestamp()
+    export_file, export_file_name = tempfile.mkstemp(prefix="export-", suffix=".zip")
 
     logging.info(
         "Downloading build from %s to %s" % (response_data["url"], export_file_name)
     )
 
-    with open(export_file_name, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            f.write(chunk)
+    try:
+        with os.fdopen(export_file, "wb") as f:
+            for chunk in r.iter_content(chunk_size=65536):
+                f.write(chunk)
+
+        changed_files = extract_crowdin_translation(
+            repository, export_file_name, source_language, target_language
+        )
+    finally:
+        os.remove(export_file_name)
+
+    if file_info:
+        crowdin_state.save_downloads(
+            repository.project_id,
+            target_language,
+            [metadata for metadata in file_info.values() if "id" in metadata],
+        )
+
+    return changed_files
+
+
+# Rather than waiting on a build of the whole destination folder, export only
+# the files whose revision or translation progress changed since we last
+# downloaded them. Edits to existing translations that leave the progress
+# unchanged are only picked up by a full build.
+
+
+def crowdin_download_changed_files(
+    repository, source_language, target_language, file_info
+):
+    downloads = crowdin_state.load_downloads(repository.project_id, target_language)
+    uploads = crowdin_state.load_uploads(repository.project_id)
+
+    changed_files = [
+        (crowdin_file, metadata)
+        for crowdin_file, metadata in file_info.items()
+        if "id" in metadata
+        and metadata.get("translated", 0) > 0
+        and is_download_changed(metadata, downloads.get(metadata["id"]))
+    ]
+
+    logging.info(
+        "Downloading %d/%d files with changed translations"
+        % (len(changed_files), len(file_info))
+    )
+
+    results = run_async_all(
+        [
+            download_file_async(
+                repository,
+                source_language,
+                target_language,
+                crowdin_file,
+                metadata,
+                uploads.get(crowdin_file),
+            )
+            for crowdin_file, metadata in changed_files
+        ]
+    )
+
+    source_hashes = {}
+    source_semantic_hashes = {}
+    target_files = []
+
+    for result in results:
+        if result is None:
+            continue
+
+        source_file, source_crc, source_semantic_hash, target_file, changed = result
+        source_hashes[source_file] = source_crc
+        source_semantic_hashes[source_file] = source_semantic_hash
+
+        if changed:
+            target_files.append(target_file)
+
+    hash_manifest.save_hashes(os.getcwd(), source_hashes, source_semantic_hashes)
+
+    crowdin_state.save_downloads(
+        repository.project_id,
+        target_language,
+        [
+            metadata
+            for (crowdin_file, metadata), result in zip(changed_files, results)
+            if result is not None
+        ],
+    )
+
+    logging.info(
+        "Updated %d/%d downloaded translations" % (len(target_files), len(results))
+    )
+
+    return target_files
+
 
-    return extract_crowdin_translation(
-        repository, export_file_name, source_language, target_language
+def is_download_changed(metadata, download):
+    return (
+        download is None
+        or download["revisionId"] != metadata.get("revisionId")
+        or download["translated"] != metadata.get("translated", 0)
+        or download["approved"] != metadata.get("approved", 0)
     )
 
 
-def crowdin_upload_sources(repository, source_language, target_language, new_files):
+async def download_file_async(
+    repository, source_language, target_language, crowdin_file, metadata, upload
+):
+    relative_path = crowdin_file[len(repository.dest_folder) + 1 :]
+
+    api_path = "/projects/%s/translations/builds/files/%s" % (
+        repository.project_id,
+        metadata["id"],
+    )
+
+    data = {"targetLanguageId": target_language}
+
+    status_code, response_data = await crowdin_request_async(api_path, "POST", data)
+
+    if response_data is None:
+        logging.error("Unable to export %s" % crowdin_file)
+        return None
+
+    target_content = await asyncio.to_thread(download_url, response_data["url"])
+
+    if target_content is None:
+        return None
+
+    # The manifest records the source that the translation was made from. If
+    # the local copy is what we last uploaded, use it rather than downloading
+    # the source again.
+
+    source_file = "%s/%s" % (source_language, relative_path)
+
+    if (
+        upload is not None
+        and upload["revisionId"] == metadata.get("revisionId")
+        and os.path.isfile(source_file)
+        and get_content_hash(source_file) == upload["contentHash"]
+    ):
+        with open(source_file, "rb") as f:
+            source_content = f.read()
+    else:
+        api_path = "/projects/%s/files/%s/download" % (
+            repository.project_id,
+            metadata["id"],
+        )
+
+        status_code, response_data = await crowdin_request_async(api_path, "GET")
+
+        if response_data is None:
+            logging.error("Unable to download source of %s" % crowdin_file)
+            return None
+
+        source_content = await asyncio.to_thread(download_url, response_data["url"])
+
+        if source_content is None:
+            return None
+
+    target_file = os.path.join(
+        repository.git_root, repository.dest_folder, target_language, relative_path
+    )
+
+    changed = True
+
+    if os.path.isfile(target_file):
+        with open(target_file, "rb") as f:
+            changed = f.read() != target_content
+
+    if changed:
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+
+        with open(target_file, "wb") as f:
+            f.write(target_content)
+
+        if source_file[-5:] == ".html":
+            await asyncio.to_thread(
+                translation_memory.harvest_file,
+                source_content,
+                target_content,
+                source_language,
+                target_language,
+            )
+
+    source_semantic_hash = None
+
+    if is_semantic_hashing_enabled():
+        source_semantic_hash = await asyncio.to_thread(
+            get_semantic_hash, source_content
+        )
+
+    return (
+        source_file,
+        zlib.crc32(source_content),
+        source_semantic_hash,
+        target_file,
+        changed,
+    )
+
+
+def download_url(url):
+    r = send_request(
+        url, lambda: get_crowdin_session().get(url, timeout=get_timeout())
+    )
+
+    if r.status_code != 200:
+        logging.error("HTTP %d downloading %s" % (r.status_code, url))
+        return None
+
+    return r.content
+
+
+def crowdin_upload_sources(
+    repository, source_language, target_language, new_files, workers=None
+):
     if source_language.find("-") != -1:
         source_language = source_language[: source_language.find("-")]
 
     if target_language.find("-") != -1:
         target_language = target_language[: target_language.find("-")]
 
+    if workers is None:
+        workers = int(os.getenv("crowdin_upload_workers", "8"))
+
     before_upload = get_crowdin_file_info(repository, target_language)
 
-    existing_files = {}
+    # Skip files whose contents match what we last uploaded, as long as
+    # Crowdin still has the revision that upload produced
 
-    for i, file in enumerate(new_files):
-        file_name = os.path.basename(file)
+    uploads = crowdin_state.load_uploads(repository.project_id)
+    content_hashes = {}
+    unchanged_files = []
 
-        logging.info("Preparing to upload file %d/%d..." % (i, len(new_files)))
+    file_hashes = hash_files(new_files, get_sha256)
 
-        directory = get_directory(repository, os.path.dirname(file))
-        directory_id = directory["id"]
+    for file in new_files:
+        crowdin_file = get_crowdin_upload_path(repository, file)
+        content_hash = file_hashes[file]
 
-        logging.info("Uploading file %d/%d (%s)..." % (i, len(new_files), file))
+        if (
+            crowdin_file in uploads
+            and crowdin_file in before_upload
+            and uploads[crowdin_file]["contentHash"] == content_hash
+            and uploads[crowdin_file]["revisionId"]
+            == before_upload[crowdin_file].get("revisionId")
+        ):
+            unchanged_files.append(file)
+        else:
+            content_hashes[file] = content_hash
 
-        status_code, response_data = upload_file_to_crowdin_storage(file)
+    if len(unchanged_files) > 0:
+        logging.info(
+            "Skipping %d files that are unchanged since their last upload"
+            % len(unchanged_files)
+        )
 
-        if directory_id not in existing_files:
-            data = {"directoryId": directory_id}
+    new_files = list(content_hashes.keys())
 
-            api_path = "/projects/%s/files" % repository.project_id
-            status_code, directory_response_data = crowdin_request(
-                api_path, "GET", data
-            )
-            existing_files[directory_id] = directory_response_data
+    if len(new_files) > 0:
+        translation_memory.report_matches(new_files, source_language, target_language)
 
-        matching_files = [
-            directory_file
-            for directory_file in existing_files[directory_id]
-            if directory_file["data"]["name"] == file_name
-        ]
+    directory_ids = {}
+
+    for i, file in enumerate(new_files):
+        folder = os.path.dirname(file)
 
-        data = {"storageId": response_data["id"]}
+        if folder in directory_ids:
+            continue
 
-        logging.info(
-            "Telling crowdin about uploaded file %d/%d (%s)..."
-            % (i, len(new_files), file_name)
+        logging.info("Preparing to upload file %d/%d..." % (i + 1, len(new_files)))
+
+        directory = get_directory(repository, folder)
+        directory_ids[folder] = directory["id"]
+
+    existing_files = dict(
+        run_async_all(
+            [
+                get_directory_files_async(repository, directory_id)
+                for directory_id in set(directory_ids.values())
+            ]
         )
+    )
 
-        if len(matching_files) == 1:
-            data["updateOption"] = "keep_translations_and_approvals"
-            file_id = matching_files[0]["data"]["id"]
-            api_path = "/projects/%s/files/%s" % (repository.project_id, file_id)
-            crowdin_request(api_path, "PUT", data)
-        else:
-            data["name"] = file_name
-            data["directoryId"] = directory_id
-            api_path = "/projects/%s/files" % repository.project_id
-            crowdin_request(api_path, "POST", data)
+    run_async(
+        crowdin_upload_pipeline_async(
+            repository,
+            new_files,
+            directory_ids,
+            existing_files,
+            content_hashes,
+            workers,
+        )
+    )
 
     if len(new_files) > 0:
+        invalidate_crowdin_file_info(repository)
         after_upload = get_crowdin_file_info(repository, target_language)
     else:
         after_upload = before_upload
 
+    if os.getenv("crowdin_prefill_translation_memory", "false") == "true":
+        file_ids = [
+            after_upload[get_crowdin_upload_path(repository, file)]["id"]
+            for file in new_files
+            if get_crowdin_upload_path(repository, file) in after_upload
+        ]
+
+        if len(file_ids) > 0:
+            prefill_translation_memory(
+                repository, source_language, target_language, file_ids
+            )
+            invalidate_crowdin_file_info(repository, file_ids)
+            after_upload = get_crowdin_file_info(repository, target_language)
+
     return before_upload, after_upload
 
 
+def get_content_hash(file):
+    return hash_file(file, get_sha256)
+
+
+def get_crowdin_upload_path(repository, file):
+    return "%s/%s" % (repository.dest_folder, file)
+
+
+async def get_directory_files_async(repository, directory_id):
+    data = {"directoryId": directory_id}
+
+    api_path = "/projects/%s/files" % repository.project_id
+    status_code, response_data = await crowdin_request_async(api_path, "GET", data)
+
+    return directory_id, response_data
+
+
+# Uploads run as a two stage pipeline: storage workers send file contents to
+# Crowdin storage, and as soon as a storage id is available, update workers
+# tell Crowdin to create or update the file with it.
+
+
+async def crowdin_upload_pipeline_async(
+    repository, new_files, directory_ids, existing_files, content_hashes, workers
+):
+    file_count = len(new_files)
+    progress = {"stored": 0, "updated": 0}
+
+    storage_queue = asyncio.Queue()
+    update_queue = asyncio.Queue()
+
+    for file in new_files:
+        storage_queue.put_nowait(file)
+
+    async def storage_worker():
+        while not storage_queue.empty():
+            file = storage_queue.get_nowait()
+
+            status_code, response_data = await upload_file_to_crowdin_storage_async(
+                file
+            )
+
+            progress["stored"] = progress["stored"] + 1
+
+            if response_data is None:
+                logging.error(
+                    "Unable to upload file %d/%d (%s) to storage"
+                    % (progress["stored"], file_count, file)
+                )
+                continue
+
+            logging.info(
+                "Uploaded file %d/%d (%s) to storage"
+                % (progress["stored"], file_count, file)
+            )
+
+            await update_queue.put((file, response_data["id"]))
+
+    async def update_worker():
+        while True:
+            item = await update_queue.get()
+
+            if item is None:
+                return
+
+            file, storage_id = item
+
+            status_code, response_data = await crowdin_update_source_async(
+                repository,
+                file,
+                storage_id,
+                directory_ids[os.path.dirname(file)],
+                existing_files,
+            )
+
+            progress["updated"] = progress["updated"] + 1
+
+            if response_data is None:
+                logging.error(
+                    "Unable to tell crowdin about uploaded file %d/%d (%s)"
+                    % (progress["updated"], file_count, file)
+                )
+                continue
+
+            crowdin_state.save_upload(
+                repository.project_id,
+                get_crowdin_upload_path(repository, file),
+                content_hashes[file],
+                response_data["id"],
+                response_data.get("revisionId"),
+            )
+
+            logging.info(
+                "Told crowdin about uploaded file %d/%d (%s)"
+                % (progress["updated"], file_count, file)
+            )
+
+    update_tasks = [asyncio.create_task(update_worker()) for i in range(workers)]
+
+    await asyncio.gather(*[storage_worker() for i in range(workers)])
+
+    for i in range(workers):
+        await update_queue.put(None)
+
+    await asyncio.gather(*update_tasks)
+
+
+async def crowdin_update_source_async(
+    repository, file, storage_id, directory_id, existing_files
+):
+    file_name = os.path.basename(file)
+
+    matching_files = [
+        directory_file
+        for directory_file in existing_files[directory_id]
+        if directory_file["data"]["name"] == file_name
+    ]
+
+    data = {"storageId": storage_id}
+
+    if len(matching_files) == 1:
+        data["updateOption"] = "keep_translations_and_approvals"
+        file_id = matching_files[0]["data"]["id"]
+        api_path = "/projects/%s/files/%s" % (repository.project_id, file_id)
+        return await crowdin_request_async(api_path, "PUT", data)
+    else:
+        data["name"] = file_name
+        data["directoryId"] = directory_id
+        api_path = "/projects/%s/files" % repository.project_id
+        return await crowdin_request_async(api_path, "POST", data)
+
+
+# Exact matches from the local translation memory are added as translations
+# before any machine translation runs, so that text we already have a
+# translation for is not sent to the machine translation engines again.
+
+
+def prefill_translation_memory(repository, source_language, target_language, file_ids):
+    results = run_async_all(
+        [
+            prefill_file_async(repository, source_language, target_language, file_id)
+            for file_id in file_ids
+        ]
+    )
+
+    logging.info(
+        "Added %d translations from the local translation memory" % sum(results)
+    )
+
+
+async def prefill_file_async(repository, source_language, target_language, file_id):
+    api_path = "/projects/%s/strings" % repository.project_id
+    data = {"fileId": file_id}
+
+    status_code, strings = await crowdin_request_async(api_path, "GET", data)
+
+    api_path = "/projects/%s/languages/%s/translations" % (
+        repository.project_id,
+        target_language,
+    )
+
+    status_code, translations = await crowdin_request_async(api_path, "GET", data)
+
+    if strings is None or translations is None:
+        return 0
+
+    translated_ids = set([item["data"]["stringId"] for item in translations])
+
+    source_texts = {
+        item["data"]["id"]: translation_memory.normalize_text(
+            BeautifulSoup(item["data"]["text"], features="html.parser").get_text()
+        )
+        for item in strings
+        if item["data"]["id"] not in translated_ids
+        and isinstance(item["data"]["text"], str)
+    }
+
+    matches = translation_memory.find_matches(
+        source_language, target_language, source_texts.values()
+    )
+
+    api_path = "/projects/%s/translations" % repository.project_id
+
+    string_ids = [
+        string_id
+        for string_id, source_text in source_texts.items()
+        if source_text in matches
+    ]
+
+    for string_id in string_ids:
+        data = {
+            "stringId": string_id,
+            "languageId": target_language,
+            "text": matches[source_texts[string_id]],
+        }
+
+        await crowdin_request_async(api_path, "POST", data)
+
+    return len(string_ids)
+
+
+def crowdin_delete_files(repository, file_ids):
+    if len(file_ids) == 0:
+        return
+
+    logging.info("Deleting %d files from crowdin" % len(file_ids))
+
+    results = run_async_all(
+        [
+            crowdin_request_async(
+                "/projects/%s/files/%s" % (repository.project_id, file_id), "DELETE"
+            )
+            for file_id in file_ids
+        ]
+    )
+
+    # A file that is already gone counts as deleted
+
+    deleted_file_ids = [
+        file_id
+        for file_id, (status_code, response_data) in zip(file_ids, results)
+        if status_code in [200, 204, 404]
+    ]
+
+    if len(deleted_file_ids) != len(file_ids):
+        logging.error(
+            "Unable to delete %d/%d files from crowdin"
+            % (len(file_ids) - len(deleted_file_ids), len(file_ids))
+        )
+
+    crowdin_state.delete_files(repository.project_id, deleted_file_ids)
+    invalidate_crowdin_file_info(repository)
+
+    return deleted_file_ids
+
+
 def extract_crowdin_translation(
     repository, export_file_name, source_language, target_language
 ):
@@ -196,98 +717,253 @@ def extract_crowdin_translation(
 
     target_folder = os.path.join(repository.git_root, repository.dest_folder)
 
+    # Only rewrite files whose contents changed, so that their modification
+    # times can be trusted by whatever checks for changes downstream
+
+    changed_files = []
+    unchanged_count = 0
+
+    source_hashes = hash_manifest.load_hashes(os.getcwd(), source_file_prefix)
+    changed_hashes = {}
+    changed_semantic_hashes = {}
+
+    # Only articles whose source or translation changed can add new segments
+    # to the translation memory
+
+    harvest_names = set()
+
     with ZipFile(export_file_name) as zipdata:
+        # Hash the local copies of the translations in parallel up front, but
+        # only where the size already matches and the contents might be equal
+
+        local_files = [
+            os.path.join(target_folder, zipinfo.filename)
+            for zipinfo in zipdata.infolist()
+            if not zipinfo.is_dir()
+            and zipinfo.filename.find(target_file_prefix) == 0
+            and os.path.isfile(os.path.join(target_folder, zipinfo.filename))
+            and os.path.getsize(os.path.join(target_folder, zipinfo.filename))
+            == zipinfo.file_size
+        ]
+
+        local_hashes = hash_files(local_files)
+
         for zipinfo in zipdata.infolist():
             if zipinfo.is_dir():
                 os.makedirs(zipinfo.filename, exist_ok=True)
                 continue
 
             if zipinfo.filename.find(source_file_prefix) == 0:
-                with open("%s.crc32" % zipinfo.filename, "w", encoding="utf-8") as f:
-                    f.write(str(zipinfo.CRC))
+                if source_hashes.get(zipinfo.filename) != str(zipinfo.CRC):
+                    changed_hashes[zipinfo.filename] = zipinfo.CRC
+                    harvest_names.add(zipinfo.filename)
+
+                    if is_semantic_hashing_enabled():
+                        changed_semantic_hashes[zipinfo.filename] = get_semantic_hash(
+                            zipdata.read(zipinfo)
+                        )
 
             if zipinfo.filename.find(target_file_prefix) == 0:
-                zipdata.extract(zipinfo, target_folder)
+                target_file = os.path.join(target_folder, zipinfo.filename)
 
-    return export_file_name
+                if local_hashes.get(target_file) == str(zipinfo.CRC):
+                    unchanged_count = unchanged_count + 1
+                    continue
 
+                zipdata.extract(zipinfo, target_folder)
+                changed_files.append(target_file)
 
-def get_missing_phrases_file_ids(repository, source_language, target_language):
-    _, file_info = get_repository_state(repository, target_language)
+                harvest_names.add(
+                    source_file_prefix + zipinfo.filename[len(target_file_prefix) :]
+                )
 
-    missing_phrases_files = {}
+        translation_memory.harvest_export(
+            zipdata, source_language, target_language, harvest_names
+        )
 
-    for crowdin_file, metadata in file_info.items():
-        if metadata["phrases"] != metadata["translated"]:
-            missing_phrases_files[metadata["id"]] = crowdin_file
+    hash_manifest.save_hashes(os.getcwd(), changed_hashes, changed_semantic_hashes)
 
-    return missing_phrases_files
+    logging.info(
+        "Extracted %d changed translations, skipped %d unchanged translations"
+        % (len(changed_files), unchanged_count)
+    )
+
+    return changed_files
 
 
 def pre_translate(repository, source_language, target_language):
     _, file_info = get_repository_state(repository, target_language)
 
-    for crowdin_file, metadata in file_info.items():
-        if metadata["phrases"] != metadata["translated"]:
-            hide_code_translations(
-                repository, source_language, target_language, crowdin_file, metadata
-            )
+    files = {
+        metadata["id"]: (crowdin_file, metadata)
+        for crowdin_file, metadata in file_info.items()
+        if metadata["phrases"] != metadata["translated"]
+    }
 
-    translate_with_machine(
-        repository, source_language, target_language, "translation memory"
+    stages = ["translation memory", "Google"]
+
+    if (
+        os.getenv("crowdin_deepl_pass", "false") == "true"
+        and source_language in ["en", "ja"]
+        and target_language in ["en", "ja"]
+    ):
+        stages.append("DeepL")
+
+    logging.info(
+        "%d files need to be updated using %s" % (len(files), " -> ".join(stages))
     )
 
-    # if source_language in ["en", "ja"] and target_language in ["en", "ja"]:
-    #     translate_with_machine(repository, source_language, target_language, "DeepL")
+    if len(files) == 0:
+        return
 
-    translate_with_machine(repository, source_language, target_language, "Google")
+    run_async(
+        pre_translate_pipeline_async(
+            repository, source_language, target_language, files, stages
+        )
+    )
 
+    invalidate_crowdin_file_info(repository, list(files.keys()))
 
-engines = {"DeepL": 245660, "Google": 213743, "translation memory": "tm"}
 
+# Each batch of files moves through code hiding and then the engine stages in
+# order, but batches move independently, so one batch can be using
+# translation memory while another is already using machine translation.
+# Before each stage, progress is refreshed for just the files in the batch,
+# and files without untranslated phrases leave the pipeline.
 
-def translate_with_machine(repository, source_language, target_language, engine_name):
-    file_ids = get_missing_phrases_file_ids(
-        repository, source_language, target_language
+
+async def pre_translate_pipeline_async(
+    repository, source_language, target_language, files, stages
+):
+    batch_size = int(os.getenv("crowdin_pre_translate_batch_size", "50"))
+    max_jobs = int(os.getenv("crowdin_pre_translate_jobs", "4"))
+
+    stage_semaphores = {stage: asyncio.Semaphore(max_jobs) for stage in stages}
+
+    file_id_list = list(files.keys())
+
+    batches = [
+        file_id_list[i : i + batch_size]
+        for i in range(0, len(file_id_list), batch_size)
+    ]
+
+    async def process_batch(batch_number, batch):
+        await asyncio.gather(
+            *[
+                hide_code_translations_async(
+                    repository,
+                    source_language,
+                    target_language,
+                    files[file_id][0],
+                    files[file_id][1],
+                )
+                for file_id in batch
+            ]
+        )
+
+        for stage in stages:
+            file_progress = await asyncio.to_thread(
+                get_file_progress, repository, target_language, batch
+            )
+
+            batch = [
+                file_id
+                for file_id in batch
+                if file_id not in file_progress
+                or file_progress[file_id]["total"]
+                != file_progress[file_id]["translated"]
+            ]
+
+            if len(batch) == 0:
+                logging.info(
+                    "Batch %d/%d is fully translated before %s"
+                    % (batch_number, len(batches), stage)
+                )
+                return
+
+            async with stage_semaphores[stage]:
+                logging.info(
+                    "Batch %d/%d: %d files need to be updated using %s"
+                    % (batch_number, len(batches), len(batch), stage)
+                )
+
+                await run_pre_translation_async(
+                    repository,
+                    target_language,
+                    stage,
+                    batch,
+                    {file_id: files[file_id][0] for file_id in batch},
+                )
+
+    await asyncio.gather(
+        *[process_batch(i + 1, batch) for i, batch in enumerate(batches)]
     )
 
-    file_count = len(file_ids)
 
-    logging.info(f"{file_count} files need to be updated using {engine_name}")
+async def run_pre_translation_async(
+    repository, target_language, engine_name, batch, file_ids
+):
+    response_data = await submit_pre_translation_async(
+        repository, target_language, engine_name, batch
+    )
 
-    if file_count == 0:
+    if response_data is None:
+        logging.error(
+            "Unable to submit %s pre-translation for %d files"
+            % (engine_name, len(batch))
+        )
         return
 
-    engine = engines[engine_name]
+    status_api_path = "/projects/%s/pre-translations/%s" % (
+        repository.project_id,
+        response_data["identifier"],
+    )
 
-    update_api_path = "/projects/%s/pre-translations" % repository.project_id
+    response_data = await crowdin_poll_async(
+        status_api_path,
+        response_data,
+        "%s pre-translation %s" % (engine_name, response_data["identifier"]),
+    )
 
-    for i, file_id in enumerate(file_ids.keys()):
+    if response_data["status"] != "finished":
+        logging.error(
+            "%s pre-translation %s was %s for %d files"
+            % (
+                engine_name,
+                response_data["identifier"],
+                response_data["status"],
+                len(batch),
+            )
+        )
+        return
+
+    for file_id in batch:
         logging.info(
-            "crowdin-api pre-translate %s (%d/%d)" % (engine, i + 1, file_count)
+            "Finished %s for %s (status: %s)"
+            % (engine_name, file_ids[file_id], response_data["status"])
         )
-        logging.info(file_ids[file_id])
 
-        data = {
-            "languageIds": [target_language],
-            "method": "tm" if engine == "tm" else "mt",
-            "autoApproveOption": "perfectMatchOnly",
-            "fileIds": [file_id],
-        }
 
-        if engine != "tm":
-            data["engineId"] = engine
+engines = {"DeepL": 245660, "Google": 213743, "translation memory": "tm"}
 
-        status_code, response_data = crowdin_request(update_api_path, "POST", data)
 
-        status_api_path = "/projects/%s/pre-translations/%s" % (
-            repository.project_id,
-            response_data["identifier"],
-        )
+async def submit_pre_translation_async(repository, target_language, engine_name, batch):
+    engine = engines[engine_name]
 
-        while response_data["finishedAt"] is None:
-            logging.info(
-                f"Waiting for {engine_name} {i+1}/{file_count} to finish..."
-            )
-            time.sleep(5)
-            status_code, response_data = crowdin_request(status_api_path, "GET", {})
+    update_api_path = "/projects/%s/pre-translations" % repository.project_id
+
+    data = {
+        "languageIds": [target_language],
+        "method": "tm" if engine == "tm" else "mt",
+        "autoApproveOption": "perfectMatchOnly",
+        "fileIds": batch,
+    }
+
+    if engine != "tm":
+        data["engineId"] = engine
+
+    status_code, response_data = await crowdin_request_async(
+        update_api_path, "POST", data
+    )
+
+    return response_data
@@ -0,0 +1,84 @@
+import asyncio
+from crowdin_util import (
+    crowdin_request,
+    get_poll_interval,
+    is_job_finished,
+    upload_file_to_crowdin_storage,
+)
+import logging
+import os
+import time
+import weakref
+
+# Asyncio wrappers around the blocking Crowdin client. Requests still go
+# through the pooled session and retry policy, but run in worker threads so
+# that callers can fan out work with asyncio.gather. The semaphore bounds how
+# many requests are in flight at once.
+
+semaphores = weakref.WeakKeyDictionary()
+
+
+def get_semaphore():
+    loop = asyncio.get_running_loop()
+
+    if loop not in semaphores:
+        semaphores[loop] = asyncio.Semaphore(
+            int(os.getenv("crowdin_async_limit", "10"))
+        )
+
+    return semaphores[loop]
+
+
+async def crowdin_request_async(api_path, method="GET", data=None, files=None):
+    async with get_semaphore():
+        return await asyncio.to_thread(
+            crowdin_request, api_path, method, data, files
+        )
+
+
+async def upload_file_to_crowdin_storage_async(file_path):
+    async with get_semaphore():
+        return await asyncio.to_thread(upload_file_to_crowdin_storage, file_path)
+
+
+async def crowdin_poll_async(
+    api_path, response_data, label, min_interval=1.0, max_interval=30.0
+):
+    started_at = time.time()
+
+    while not is_job_finished(response_data):
+        progress = response_data.get("progress", 0)
+        interval = get_poll_interval(started_at, progress, min_interval, max_interval)
+
+        logging.info(
+            "Waiting for %s to finish (%d%% complete, next check in %.1f seconds)..."
+            % (label, progress, interval)
+        )
+
+        await asyncio.sleep(interval)
+
+        status_code, new_response_data = await crowdin_request_async(
+            api_path, "GET", {}
+        )
+
+        if new_response_data is not None:
+            response_data = new_response_data
+
+    return response_data
+
+
+def crowdin_poll(api_path, response_data, label, min_interval=1.0, max_interval=30.0):
+    return run_async(
+        crowdin_poll_async(api_path, response_data, label, min_interval, max_interval)
+    )
+
+
+def run_async(coroutine):
+    return asyncio.run(coroutine)
+
+
+def run_async_all(coroutines):
+    async def gather_all():
+        return await asyncio.gather(*coroutines)
+
+    return asyncio.run(gather_all())
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+from crowdin_async import crowdin_request_async, run_async, run_async_all
+import crowdin_state
 from crowdin_util import CrowdInRepository, crowdin_request, get_crowdin_file_info
+from datetime import datetime, timedelta, timezone
 import logging
 import sys
 
@@ -46,9 +49,9 @@ def check_pre_translations(
             target_language,
         )
 
-        pagination_data = {"fileId": file_metadata["id"], "offset": 0, "limit": 500}
-
-        status_code, response_data = crowdin_request(api_path, "GET", pagination_data)
+        status_code, response_data = crowdin_request(
+            api_path, "GET", {"fileId": file_metadata["id"]}
+        )
 
         for item in response_data:
             if is_malformed_translation(item["data"]["text"]):
@@ -61,36 +64,167 @@ def check_pre_translations(
 
 
 def hide_code_translations(
-    repository, source_language, target_language, file_name, file_metadata
+    repository, source_language, target_language, file_name, file_metadata, force=False
+):
+    return run_async(
+        hide_code_translations_async(
+            repository,
+            source_language,
+            target_language,
+            file_name,
+            file_metadata,
+            force,
+        )
+    )
+
+
+async def hide_code_translations_async(
+    repository, source_language, target_language, file_name, file_metadata, force=False
 ):
     logging.info("Checking auto code translations for file %s" % file_name)
 
     project_id = repository.project_id
     file_id = file_metadata["id"]
+    revision_id = file_metadata.get("revisionId")
 
-    status_code, response_data = crowdin_request(
-        "/projects/%s/strings" % project_id, "GET", {"fileId": file_id}
+    # Only strings added or updated since the last check can need a change,
+    # and nothing can have changed if the file revision did not move. A forced
+    # check looks at every string again.
+
+    last_check = None
+
+    if not force:
+        last_check = crowdin_state.load_hidden_check(project_id, file_id)
+
+    if last_check is not None and last_check["revisionId"] == revision_id:
+        logging.info("Skipping unchanged revision %s of %s" % (revision_id, file_name))
+        return False
+
+    checked_at = (datetime.now(timezone.utc) - timedelta(minutes=5)).strftime(
+        "%Y-%m-%dT%H:%M:%S+00:00"
     )
 
-    for entry in response_data:
-        is_hide_translation = (
-            entry["data"]["context"].find("/pre") != -1
-            or entry["data"]["context"].find("/code") != -1
-        )
-        was_hidden_translation = entry["data"]["isHidden"]
-        string_id = entry["data"]["id"]
+    since = None if last_check is None else last_check["checkedAt"]
 
-        if is_hide_translation == was_hidden_translation:
-            continue
+    hidden_states = await get_hidden_state_changes_async(project_id, file_id, since)
 
-        if is_hide_translation:
-            set_translation_hidden(repository, project_id, string_id, True)
-        else:
-            set_translation_hidden(repository, project_id, string_id, False)
+    if hidden_states is None:
+        return False
+
+    # Only remember the revision as checked if the strings were updated, so
+    # that a failed update is retried on the next run
+
+    if not await set_translations_hidden_async(project_id, hidden_states):
+        return False
+
+    crowdin_state.save_hidden_check(
+        project_id, file_id, revision_id, checked_at, hidden_states
+    )
 
     return False
 
 
+# Ask Crowdin for only the strings whose hidden flag needs to change. If the
+# query is rejected as invalid, fall back to listing every string in the file.
+# Any other failure leaves the file to be checked again on the next run.
+
+code_context_croql = 'context contains "/pre" or context contains "/code"'
+
+hidden_state_queries = {
+    True: "not is hidden and (%s)" % code_context_croql,
+    False: "is hidden and not (%s)" % code_context_croql,
+}
+
+use_croql = True
+use_croql_dates = True
+
+
+def is_code_context(entry):
+    return (
+        entry["data"]["context"].find("/pre") != -1
+        or entry["data"]["context"].find("/code") != -1
+    )
+
+
+def is_changed_since(entry, since):
+    if since is None:
+        return True
+
+    created_at = entry["data"].get("createdAt")
+    updated_at = entry["data"].get("updatedAt")
+
+    return (
+        created_at is None
+        or parse_timestamp(created_at) >= parse_timestamp(since)
+        or updated_at is not None
+        and parse_timestamp(updated_at) >= parse_timestamp(since)
+    )
+
+
+def parse_timestamp(value):
+    return datetime.strptime(value[:-3] + value[-2:], "%Y-%m-%dT%H:%M:%S%z")
+
+
+async def get_hidden_state_changes_async(project_id, file_id, since=None):
+    global use_croql, use_croql_dates
+
+    api_path = "/projects/%s/strings" % project_id
+
+    while use_croql:
+        hidden_states = {}
+
+        date_croql = None
+
+        if since is not None and use_croql_dates:
+            date_croql = 'added >= "%s" or updated >= "%s"' % (since, since)
+
+        for is_hidden, croql in hidden_state_queries.items():
+            if date_croql is not None:
+                croql = "(%s) and (%s)" % (croql, date_croql)
+
+            status_code, response_data = await crowdin_request_async(
+                api_path, "GET", {"fileId": file_id, "croql": croql}
+            )
+
+            if response_data is None:
+                if status_code != 400:
+                    logging.error("Unable to list strings for file %s" % file_id)
+                    return None
+
+                break
+
+            for entry in response_data:
+                if (
+                    is_code_context(entry) == is_hidden
+                    and entry["data"]["isHidden"] != is_hidden
+                ):
+                    hidden_states[entry["data"]["id"]] = is_hidden
+        else:
+            return hidden_states
+
+        if date_croql is not None:
+            logging.info("CroQL date filter unavailable, checking all code strings")
+            use_croql_dates = False
+        else:
+            logging.info("CroQL string filter unavailable, listing all strings")
+            use_croql = False
+
+    status_code, response_data = await crowdin_request_async(
+        api_path, "GET", {"fileId": file_id}
+    )
+
+    if response_data is None:
+        logging.error("Unable to list strings for file %s" % file_id)
+        return None
+
+    return {
+        entry["data"]["id"]: is_code_context(entry)
+        for entry in response_data
+        if is_code_context(entry) != entry["data"]["isHidden"]
+        and is_changed_since(entry, since)
+    }
+
+
 def is_malformed_translation(text):
     open_tags = []
 
@@ -160,24 +294,48 @@ def process_code_translations(
 
     file_info = get_crowdin_file_info(repository, target_language)
 
-    for file_name, file_metadata in file_info.items():
-        if (
-            force
+    run_async_all(
+        [
+            hide_code_translations_async(
+                repository,
+                source_language,
+                target_language,
+                file_name,
+                file_metadata,
+                force,
+            )
+            for file_name, file_metadata in file_info.items()
+            if force
             or "id" in file_metadata
             and file_metadata["phrases"] != file_metadata["translated"]
-        ):
-            hide_code_translations(
-                repository, source_language, target_language, file_name, file_metadata
-            )
+        ]
+    )
+
+
+async def set_translations_hidden_async(project_id, hidden_states):
+    if len(hidden_states) == 0:
+        return True
 
+    logging.info("Updating hidden flag for %d strings" % len(hidden_states))
 
-def set_translation_hidden(repository, project_id, string_id, is_hidden):
-    crowdin_request(
-        "/projects/%s/strings/%s" % (project_id, string_id),
+    status_code, response_data = await crowdin_request_async(
+        "/projects/%s/strings" % project_id,
         "PATCH",
-        [{"op": "replace", "path": "/isHidden", "value": is_hidden}],
+        [
+            {"op": "replace", "path": "/%s/isHidden" % string_id, "value": is_hidden}
+            for string_id, is_hidden in hidden_states.items()
+        ],
     )
 
+    if response_data is None:
+        logging.error(
+            "Unable to update hidden flag for %d strings (HTTP %d)"
+            % (len(hidden_states), status_code)
+        )
+        return False
+
+    return True
+
 
 if __name__ == "__main__":
     try:
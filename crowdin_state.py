@@ -0,0 +1,326 @@
+import json
+from session import initial_dir
+import sqlite3
+import threading
+
+# Local copy of the Crowdin file metadata and translation progress, so that
+# progress only has to be fetched for files that changed since the last run.
+
+state_file = "%s/crowdin_state.db" % initial_dir
+state_lock = threading.Lock()
+
+schema = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        project_id TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        revision_id INTEGER,
+        updated_at TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (project_id, file_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS file_progress (
+        project_id TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        language TEXT NOT NULL,
+        revision_id INTEGER,
+        updated_at TEXT,
+        phrases INTEGER NOT NULL,
+        translated INTEGER NOT NULL,
+        approved INTEGER NOT NULL,
+        PRIMARY KEY (project_id, file_id, language)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS uploads (
+        project_id TEXT NOT NULL,
+        path TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        revision_id INTEGER,
+        PRIMARY KEY (project_id, path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS hidden_checks (
+        project_id TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        revision_id INTEGER,
+        checked_at TEXT NOT NULL,
+        hidden_count INTEGER NOT NULL,
+        visible_count INTEGER NOT NULL,
+        PRIMARY KEY (project_id, file_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS downloads (
+        project_id TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        language TEXT NOT NULL,
+        revision_id INTEGER,
+        translated INTEGER NOT NULL,
+        approved INTEGER NOT NULL,
+        PRIMARY KEY (project_id, file_id, language)
+    )
+    """,
+]
+
+
+def connect():
+    connection = sqlite3.connect(state_file, timeout=60)
+
+    for statement in schema:
+        connection.execute(statement)
+
+    return connection
+
+
+def save_files(project_id, files):
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        str(project_id),
+                        file["id"],
+                        file["path"],
+                        file.get("revisionId"),
+                        file.get("updatedAt"),
+                        json.dumps(file),
+                    )
+                    for file in files
+                ],
+            )
+
+        connection.close()
+
+
+def delete_files(project_id, file_ids):
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            for table in [
+                "files",
+                "file_progress",
+                "uploads",
+                "hidden_checks",
+                "downloads",
+            ]:
+                connection.executemany(
+                    "DELETE FROM %s WHERE project_id = ? AND file_id = ?" % table,
+                    [(str(project_id), file_id) for file_id in file_ids],
+                )
+
+        connection.close()
+
+
+def load_file_progress(project_id, language):
+    with state_lock:
+        connection = connect()
+
+        rows = connection.execute(
+            """
+            SELECT file_id, revision_id, updated_at, phrases, translated, approved
+            FROM file_progress WHERE project_id = ? AND language = ?
+            """,
+            (str(project_id), language),
+        ).fetchall()
+
+        connection.close()
+
+    return {
+        file_id: {
+            "revisionId": revision_id,
+            "updatedAt": updated_at,
+            "total": phrases,
+            "translated": translated,
+            "approved": approved,
+        }
+        for file_id, revision_id, updated_at, phrases, translated, approved in rows
+    }
+
+
+def save_file_progress(project_id, language, files, file_progress):
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO file_progress VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        str(project_id),
+                        file["id"],
+                        language,
+                        file.get("revisionId"),
+                        file.get("updatedAt"),
+                        file_progress[file["id"]]["total"],
+                        file_progress[file["id"]]["translated"],
+                        file_progress[file["id"]]["approved"],
+                    )
+                    for file in files
+                    if file["id"] in file_progress
+                ],
+            )
+
+        connection.close()
+
+
+def clear_file_progress(project_id, file_ids=None):
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            if file_ids is None:
+                connection.execute(
+                    "DELETE FROM file_progress WHERE project_id = ?",
+                    (str(project_id),),
+                )
+            else:
+                connection.executemany(
+                    "DELETE FROM file_progress WHERE project_id = ? AND file_id = ?",
+                    [(str(project_id), file_id) for file_id in file_ids],
+                )
+
+        connection.close()
+
+
+def load_uploads(project_id):
+    with state_lock:
+        connection = connect()
+
+        rows = connection.execute(
+            """
+            SELECT path, content_hash, file_id, revision_id
+            FROM uploads WHERE project_id = ?
+            """,
+            (str(project_id),),
+        ).fetchall()
+
+        connection.close()
+
+    return {
+        path: {
+            "contentHash": content_hash,
+            "fileId": file_id,
+            "revisionId": revision_id,
+        }
+        for path, content_hash, file_id, revision_id in rows
+    }
+
+
+def save_upload(project_id, path, content_hash, file_id, revision_id):
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                (str(project_id), path, content_hash, file_id, revision_id),
+            )
+
+        connection.close()
+
+
+def load_hidden_check(project_id, file_id):
+    with state_lock:
+        connection = connect()
+
+        row = connection.execute(
+            """
+            SELECT revision_id, checked_at FROM hidden_checks
+            WHERE project_id = ? AND file_id = ?
+            """,
+            (str(project_id), file_id),
+        ).fetchone()
+
+        connection.close()
+
+    if row is None:
+        return None
+
+    return {"revisionId": row[0], "checkedAt": row[1]}
+
+
+def save_hidden_check(project_id, file_id, revision_id, checked_at, hidden_states):
+    hidden_count = len([x for x in hidden_states.values() if x])
+    visible_count = len(hidden_states) - hidden_count
+
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            connection.execute(
+                """
+                INSERT INTO hidden_checks VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (project_id, file_id) DO UPDATE SET
+                    revision_id = excluded.revision_id,
+                    checked_at = excluded.checked_at,
+                    hidden_count = hidden_count + excluded.hidden_count,
+                    visible_count = visible_count + excluded.visible_count
+                """,
+                (
+                    str(project_id),
+                    file_id,
+                    revision_id,
+                    checked_at,
+                    hidden_count,
+                    visible_count,
+                ),
+            )
+
+        connection.close()
+
+
+def load_downloads(project_id, language):
+    with state_lock:
+        connection = connect()
+
+        rows = connection.execute(
+            """
+            SELECT file_id, revision_id, translated, approved
+            FROM downloads WHERE project_id = ? AND language = ?
+            """,
+            (str(project_id), language),
+        ).fetchall()
+
+        connection.close()
+
+    return {
+        file_id: {
+            "revisionId": revision_id,
+            "translated": translated,
+            "approved": approved,
+        }
+        for file_id, revision_id, translated, approved in rows
+    }
+
+
+def save_downloads(project_id, language, files):
+    with state_lock:
+        connection = connect()
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        str(project_id),
+                        file["id"],
+                        language,
+                        file.get("revisionId"),
+                        file.get("translated", 0),
+                        file.get("approved", 0),
+                    )
+                    for file in files
+                ],
+            )
+
+        connection.close()
@@ -1,5 +1,10 @@
+import atexit
 from bs4 import BeautifulSoup
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import crowdin_state
+from http_retry import get_timeout, send_request
 import json
 import logging
 import onepass
@@ -8,8 +13,11 @@ import pandas as pd
 import pickle
 import random
 import requests
+from requests.adapters import HTTPAdapter
 from session import initial_dir, session
+import threading
 import time
+import zlib
 
 # Retrieve information from 1password
 
@@ -117,18 +125,98 @@ def crowdin_authenticate(path):
 
 
 crowdin_base_url = "https://api.crowdin.com/api"
+crowdin_page_size = 500
 user_id = None
 
+# Shared keep-alive connection pool for the Crowdin API, storage uploads and
+# build downloads. It is created lazily so that settings loaded via dotenv
+# after this module is imported are still honored.
 
-def crowdin_request(api_path, method="GET", data=None, files=None):
-    for i in range(0, 4):
-        try:
-            return crowdin_request_helper(api_path, method, data, files)
-        except:
-            print('Exception requesting URL %s, retrying in 60 seconds' % api_path)
-            time.sleep(60)
-            pass
+crowdin_session = None
+crowdin_session_lock = threading.Lock()
+
+
+def get_crowdin_session():
+    global crowdin_session
+
+    with crowdin_session_lock:
+        if crowdin_session is not None:
+            return crowdin_session
+
+        pool_connections = int(os.getenv("crowdin_pool_connections", "10"))
+        pool_maxsize = int(os.getenv("crowdin_pool_maxsize", "20"))
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+
+        crowdin_session = requests.Session()
+        crowdin_session.mount("https://", adapter)
+        crowdin_session.mount("http://", adapter)
+
+        return crowdin_session
+
+
+def get_connection_stats():
+    request_count = 0
+    connection_count = 0
+
+    with crowdin_session_lock:
+        if crowdin_session is None:
+            return (0, 0, 0)
+
+        for adapter in set(crowdin_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+
+            for key in pools.keys():
+                pool = pools.get(key)
+
+                if pool is None:
+                    continue
+
+                request_count = request_count + pool.num_requests
+                connection_count = connection_count + pool.num_connections
+
+    return (request_count, connection_count, request_count - connection_count)
+
+
+def log_connection_stats():
+    request_count, connection_count, reuse_count = get_connection_stats()
+
+    if request_count == 0:
+        return
+
+    logging.info(
+        "Crowdin HTTP connections: %d requests, %d opened, %d reused"
+        % (request_count, connection_count, reuse_count)
+    )
+
+
+atexit.register(log_connection_stats)
+
+
+# Count the requests sent to the Crowdin API, including retries, so that long
+# runs can budget them. Downloads of builds and files are not API requests.
+
+crowdin_request_count = 0
+crowdin_request_count_lock = threading.Lock()
+
+
+def count_crowdin_request(send):
+    global crowdin_request_count
+
+    with crowdin_request_count_lock:
+        crowdin_request_count = crowdin_request_count + 1
+
+    return send()
 
+
+def get_crowdin_request_count():
+    with crowdin_request_count_lock:
+        return crowdin_request_count
+
+
+def crowdin_request(api_path, method="GET", data=None, files=None):
     return crowdin_request_helper(api_path, method, data, files)
 
 
@@ -138,8 +226,11 @@ def crowdin_request_helper(api_path, method="GET", data=None, files=None):
     if data is None:
         data = {}
 
+    if method == "GET":
+        data = dict(data)
+        data["limit"] = crowdin_page_size
+
     offset = data["offset"] if "offset" in data else 0
-    limit = data["limit"] if "limit" in data else 25
 
     print("%s (offset=%d)" % (api_path, offset))
 
@@ -155,19 +246,21 @@ def crowdin_request_helper(api_path, method="GET", data=None, files=None):
 
     request_url = crowdin_base_url + "/v2" + api_path
 
-    if method == "DELETE":
-        r = requests.delete(request_url, params=data, headers=headers)
-    elif method == "GET":
-        r = requests.get(request_url, params=data, headers=headers)
-    elif method == "PATCH":
-        r = requests.patch(request_url, json=data, headers=headers)
-    elif method == "POST":
-        r = requests.post(request_url, json=data, headers=headers)
-    elif method == "PUT":
-        r = requests.put(request_url, json=data, headers=headers)
+    api_session = get_crowdin_session()
+
+    if method == "DELETE" or method == "GET":
+        send = lambda: api_session.request(
+            method, request_url, params=data, headers=headers, timeout=get_timeout()
+        )
+    elif method == "PATCH" or method == "POST" or method == "PUT":
+        send = lambda: api_session.request(
+            method, request_url, json=data, headers=headers, timeout=get_timeout()
+        )
     else:
         raise Exception("Unrecognized method: %s" % method)
 
+    r = send_request(request_url, lambda: count_crowdin_request(send), method)
+
     if r.status_code == 204:
         return (r.status_code, None)
 
@@ -193,20 +286,67 @@ def crowdin_request_helper(api_path, method="GET", data=None, files=None):
     if method != "GET" or "pagination" not in response or offset != 0:
         return (r.status_code, response_data)
 
-    status_code = r.status_code
+    return crowdin_paginate(api_path, data, r.status_code, response_data)
+
 
+def crowdin_paginate(api_path, data, status_code, response_data):
     results = []
     results.extend(response_data)
 
-    while len(response_data) == limit:
-        offset = offset + limit
-        data["offset"] = offset
-        data["limit"] = limit
+    if len(response_data) < crowdin_page_size:
+        return (status_code, results)
 
-        status_code, response_data = crowdin_request(api_path, method, data, files)
-        results.extend(response_data)
+    prefetch_pages = int(os.getenv("crowdin_prefetch_pages", "4"))
+    offset = crowdin_page_size
 
-    return (status_code, results)
+    with ThreadPoolExecutor(max_workers=prefetch_pages) as executor:
+        while True:
+            futures = []
+
+            for i in range(prefetch_pages):
+                page_data = dict(data)
+                page_data["offset"] = offset + i * crowdin_page_size
+
+                futures.append(
+                    executor.submit(crowdin_request, api_path, "GET", page_data)
+                )
+
+            for future in futures:
+                status_code, response_data = future.result()
+
+                if response_data is None:
+                    raise Exception(
+                        "Unable to retrieve page of %s (status code: %d)"
+                        % (api_path, status_code)
+                    )
+
+                results.extend(response_data)
+
+                if len(response_data) < crowdin_page_size:
+                    return (status_code, results)
+
+            offset = offset + prefetch_pages * crowdin_page_size
+
+
+# Builds and pre-translations report a progress percentage, which is used to
+# estimate how long the remaining work will take and wait about half that.
+
+
+def get_poll_interval(started_at, progress, min_interval=1.0, max_interval=30.0):
+    elapsed = time.time() - started_at
+
+    if progress is None or progress <= 0:
+        remaining = elapsed
+    elif progress >= 100:
+        remaining = 0
+    else:
+        remaining = elapsed * (100 - progress) / progress / 2
+
+    return max(min_interval, min(max_interval, remaining))
+
+
+def is_job_finished(response_data):
+    return response_data["status"] in ["finished", "failed", "canceled"]
 
 
 def get_crowdin_file(repository, local_file):
@@ -218,6 +358,9 @@ def get_crowdin_file(repository, local_file):
     return None
 
 
+file_info_cache = {}
+
+
 def get_crowdin_file_info(repository, target_language):
     if target_language[0:2] == "ja":
         target_language = "ja"
@@ -226,16 +369,26 @@ def get_crowdin_file_info(repository, target_language):
     if target_language[0:2] == "en":
         target_language = "en"
 
+    cache_key = (str(repository.project_id), repository.dest_folder, target_language)
+
+    if cache_key in file_info_cache:
+        return copy.deepcopy(file_info_cache[cache_key])
+
     file_info = {}
     item_paths = {}
 
-    pagination_data = {"offset": 0, "limit": 500}
+    # Fetch the list of files underneath the destination folder
+
+    dest_directory = get_directory(repository, "", False)
 
-    # Fetch the list of files
+    if dest_directory is None:
+        logging.info("Unable to find data directory %s" % repository.dest_folder)
+        return file_info
 
     api_path = "/projects/%s/files" % repository.project_id
+    data = {"directoryId": dest_directory["id"], "recursion": 1}
 
-    status_code, response_data = crowdin_request(api_path, "GET", pagination_data)
+    status_code, response_data = crowdin_request(api_path, "GET", data)
 
     for item in response_data:
         item_path = (
@@ -255,52 +408,128 @@ def get_crowdin_file_info(repository, target_language):
         % (len(file_info), len(response_data), repository.dest_folder)
     )
 
-    # Fetch the list of translation statuses
+    # Fetch the translation status of files that changed since we last checked,
+    # or which were still missing translations
 
-    pagination_data["offset"] = 0
-    api_path = "/projects/%s/languages/%s/progress" % (
-        repository.project_id,
-        target_language,
+    files = [item["data"] for item in response_data]
+    file_progress = crowdin_state.load_file_progress(
+        repository.project_id, target_language
     )
 
-    while True:
-        status_code, response_data = crowdin_request(api_path, "GET", pagination_data)
+    stale_files = [
+        file
+        for file in files
+        if file["id"] not in file_progress
+        or file_progress[file["id"]]["revisionId"] != file.get("revisionId")
+        or file_progress[file["id"]]["updatedAt"] != file.get("updatedAt")
+        or file_progress[file["id"]]["total"]
+        != file_progress[file["id"]]["translated"]
+    ]
 
-        for item in response_data:
-            key = item["data"]["fileId"]
+    logging.info(
+        "Refreshing translation progress for %d/%d files"
+        % (len(stale_files), len(files))
+    )
 
-            if key not in item_paths:
-                continue
+    new_file_progress = get_file_progress(
+        repository, target_language, [file["id"] for file in stale_files]
+    )
 
-            item_path = item_paths[key]
+    crowdin_state.save_files(repository.project_id, files)
+    crowdin_state.save_file_progress(
+        repository.project_id, target_language, stale_files, new_file_progress
+    )
 
-            if item_path in file_info:
-                file_info[item_path]["phrases"] = item["data"]["phrases"]["total"]
-                file_info[item_path]["translated"] = item["data"]["phrases"][
-                    "translated"
-                ]
-                file_info[item_path]["approved"] = item["data"]["phrases"]["approved"]
+    file_progress.update(new_file_progress)
 
-        if len(response_data) < 500:
-            break
+    for file_id, phrases in file_progress.items():
+        if file_id not in item_paths:
+            continue
 
-        pagination_data["offset"] = pagination_data["offset"] + 500
+        item_path = item_paths[file_id]
 
-    return file_info
+        if item_path in file_info:
+            file_info[item_path]["phrases"] = phrases["total"]
+            file_info[item_path]["translated"] = phrases["translated"]
+            file_info[item_path]["approved"] = phrases["approved"]
 
+    file_info_cache[cache_key] = file_info
 
-def get_directory(repository, subfolder, create_if_missing=True):
-    path = f"/{repository.dest_folder}/{subfolder}"
+    return copy.deepcopy(file_info)
 
-    if path[-1] == '/':
-        path = path[:-1]
 
-    logging.info("Looking up CrowdIn directory for path %s..." % path)
+def invalidate_crowdin_file_info(repository, file_ids=None):
+    for cache_key in list(file_info_cache.keys()):
+        if cache_key[0] == str(repository.project_id):
+            del file_info_cache[cache_key]
+
+    if file_ids is not None:
+        crowdin_state.clear_file_progress(repository.project_id, file_ids)
+
+
+def get_file_progress(repository, target_language, file_ids):
+    if len(file_ids) == 0:
+        return {}
+
+    # The language progress endpoint cannot be filtered by directory, so when
+    # only a handful of files are involved, ask for each file's progress
+    # instead of listing the whole project.
 
-    pagination_data = {"offset": 0, "limit": 500}
+    if len(file_ids) > int(os.getenv("crowdin_file_progress_limit", "200")):
+        api_path = "/projects/%s/languages/%s/progress" % (
+            repository.project_id,
+            target_language,
+        )
+
+        status_code, response_data = crowdin_request(api_path, "GET", {})
+
+        file_id_set = set(file_ids)
+
+        return {
+            item["data"]["fileId"]: item["data"]["phrases"]
+            for item in response_data
+            if item["data"]["fileId"] in file_id_set
+        }
+
+    def get_single_file_progress(file_id):
+        api_path = "/projects/%s/files/%s/languages/progress" % (
+            repository.project_id,
+            file_id,
+        )
+
+        status_code, response_data = crowdin_request(api_path, "GET", {})
+
+        if response_data is None:
+            return None
+
+        for item in response_data:
+            if item["data"]["languageId"] == target_language:
+                return item["data"]["phrases"]
+
+        return None
+
+    max_workers = int(os.getenv("crowdin_async_limit", "10"))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        file_progress = zip(file_ids, executor.map(get_single_file_progress, file_ids))
+
+        return {
+            file_id: phrases
+            for file_id, phrases in file_progress
+            if phrases is not None
+        }
+
+
+directory_index_file = "%s/crowdin_directories.json" % initial_dir
+directory_indexes = {}
+refreshed_directory_indexes = set()
+
+
+def fetch_directory_index(repository):
+    logging.info("Retrieving CrowdIn directory list...")
 
     api_path = "/projects/%s/directories" % repository.project_id
-    status_code, response_data = crowdin_request(api_path, "GET", pagination_data)
+    status_code, response_data = crowdin_request(api_path, "GET", {})
 
     directories = {
         directory["data"]["id"]: directory["data"] for directory in response_data
@@ -327,35 +556,131 @@ def get_directory(repository, subfolder, create_if_missing=True):
 
         directory_paths[directory_path] = directory
 
+    refreshed_directory_indexes.add(str(repository.project_id))
+
+    return directory_paths
+
+
+def is_valid_directory_index(repository, directory_paths):
+    path = "/%s" % repository.dest_folder
+
+    if path not in directory_paths:
+        return False
+
+    directory = directory_paths[path]
+
+    api_path = "/projects/%s/directories/%s" % (repository.project_id, directory["id"])
+    status_code, response_data = crowdin_request(api_path, "GET", {})
+
+    return (
+        status_code == 200
+        and response_data is not None
+        and response_data["name"] == directory["name"]
+        and response_data["directoryId"] == directory["directoryId"]
+    )
+
+
+def get_directory_index(repository, refresh=False):
+    project_id = str(repository.project_id)
+
+    if refresh:
+        directory_indexes[project_id] = fetch_directory_index(repository)
+        save_directory_index()
+        return directory_indexes[project_id]
+
+    if project_id in directory_indexes:
+        return directory_indexes[project_id]
+
+    directory_paths = load_saved_directory_indexes().get(project_id, {})
+
+    if is_valid_directory_index(repository, directory_paths):
+        logging.info("Using cached CrowdIn directory list")
+        directory_indexes[project_id] = directory_paths
+    else:
+        directory_indexes[project_id] = fetch_directory_index(repository)
+        save_directory_index()
+
+    return directory_indexes[project_id]
+
+
+def load_saved_directory_indexes():
+    if not os.path.isfile(directory_index_file):
+        return {}
+
+    try:
+        with open(directory_index_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+# Several projects share the same file, so keep the saved indexes of any
+# project that this run did not load.
+
+
+def save_directory_index():
+    saved_indexes = load_saved_directory_indexes()
+    saved_indexes.update(directory_indexes)
+
+    with open(directory_index_file, "w", encoding="utf-8") as f:
+        json.dump(saved_indexes, f)
+
+
+def remove_directory_index_entries(repository, subfolder):
+    path = f"/{repository.dest_folder}/{subfolder}"
+
+    if path[-1] == "/":
+        path = path[:-1]
+
+    directory_paths = get_directory_index(repository)
+
+    for directory_path in list(directory_paths.keys()):
+        if directory_path == path or directory_path.find(path + "/") == 0:
+            del directory_paths[directory_path]
+
+    save_directory_index()
+
+
+def get_directory(repository, subfolder, create_if_missing=True):
+    path = f"/{repository.dest_folder}/{subfolder}"
+
+    if path[-1] == '/':
+        path = path[:-1]
+
+    logging.info("Looking up CrowdIn directory for path %s..." % path)
+
+    directory_paths = get_directory_index(repository)
+
     if path in directory_paths:
         return directory_paths[path]
 
     if not create_if_missing:
         return None
 
+    # The cached index might predate directories created elsewhere, so check
+    # against a fresh listing once before creating anything
+
+    if str(repository.project_id) not in refreshed_directory_indexes:
+        directory_paths = get_directory_index(repository, True)
+
+        if path in directory_paths:
+            return directory_paths[path]
+
     parent_path = os.path.dirname(path)
 
-    while (
-        parent_path not in directory_paths and parent_path != "/" and parent_path != ""
-    ):
+    while parent_path not in directory_paths and parent_path != "/":
         parent_path = os.path.dirname(parent_path)
 
-    if parent_path == "":
-        parent_directory = None
-        path_elements = path.split("/")
-    elif parent_path == "/":
+    if parent_path == "/":
         parent_directory = None
-        path_elements = path[1:].split("/")
+        parent_path = ""
     else:
         parent_directory = directory_paths[parent_path]
-        path_elements = path[len(parent_path) + 1 :].split("/")
 
-    for i, name in enumerate(path_elements):
-        parent_path = "/" + "/".join(path_elements[: i + 1])
+    api_path = "/projects/%s/directories" % repository.project_id
 
-        if parent_path in directory_paths:
-            parent_directory = directory_paths[parent_path]
-            continue
+    for name in path[len(parent_path) + 1 :].split("/"):
+        parent_path = parent_path + "/" + name
 
         logging.info("Creating subdirectory %s", parent_path)
 
@@ -368,6 +693,13 @@ def get_directory(repository, subfolder, create_if_missing=True):
 
         status_code, parent_directory = crowdin_request(api_path, "POST", data)
 
+        if parent_directory is None:
+            raise Exception("Unable to create CrowdIn directory %s" % parent_path)
+
+        directory_paths[parent_path] = parent_directory
+
+    save_directory_index()
+
     return parent_directory
 
 
@@ -475,6 +807,18 @@ def get_translation_path(file, source_language, target_language):
         )
 
 
+def get_gzip_chunks(f, chunk_size=65536):
+    compressor = zlib.compressobj(wbits=31)
+
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        compressed_chunk = compressor.compress(chunk)
+
+        if len(compressed_chunk) > 0:
+            yield compressed_chunk
+
+    yield compressor.flush()
+
+
 def upload_file_to_crowdin_storage(file_path):
     global user_id
 
@@ -491,8 +835,32 @@ def upload_file_to_crowdin_storage(file_path):
 
     api_path = crowdin_base_url + "/v2/storages"
 
-    with open(file_path, "rb") as f:
-        r = requests.post(api_path, data=f.read(), headers=headers)
+    use_gzip = os.getenv("crowdin_gzip_uploads", "false") == "true"
+
+    if use_gzip:
+        headers["content-encoding"] = "gzip"
+
+    # Stream the body straight from the file handle, so that concurrent
+    # uploads do not each hold a full copy of their file in memory
+
+    def send():
+        request_headers = headers.copy()
+
+        with open(file_path, "rb") as f:
+            if use_gzip:
+                body = get_gzip_chunks(f)
+            else:
+                body = f
+                request_headers["content-length"] = str(os.fstat(f.fileno()).st_size)
+
+            return get_crowdin_session().post(
+                api_path, data=body, headers=request_headers, timeout=get_timeout()
+            )
+
+    # A repeated storage upload only leaves an unused storage behind, which
+    # Crowdin removes on its own
+
+    r = send_request(api_path, lambda: count_crowdin_request(send), "POST", True)
 
     if r.status_code == 401:
         logging.error("Invalid user name or password")
@@ -0,0 +1,137 @@
+from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
+import zlib
+
+# Hash many files at once. Files are memory-mapped rather than read into
+# memory, and zlib and hashlib release the GIL while they digest a buffer, so
+# a thread pool keeps every core busy.
+
+
+def get_crc32(data):
+    return str(zlib.crc32(data))
+
+
+def get_sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Hash only the translatable text of an HTML document, so that changes to the
+# markup alone (attributes, CDN URLs, whitespace, &nbsp; and smart quotes) do
+# not count as a change to the content. Block elements end a line, so that
+# splitting or merging paragraphs still does.
+
+semantic_replacements = [
+    ("\xa0", " "),
+    ("\u2018", "'"),
+    ("\u2019", "'"),
+    ("\u201c", '"'),
+    ("\u201d", '"'),
+]
+
+translatable_attributes = ["alt", "title"]
+
+block_tags = [
+    "blockquote",
+    "br",
+    "caption",
+    "dd",
+    "div",
+    "dl",
+    "dt",
+    "figcaption",
+    "figure",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "li",
+    "ol",
+    "p",
+    "pre",
+    "section",
+    "table",
+    "td",
+    "th",
+    "tr",
+    "ul",
+]
+
+
+def get_semantic_hash(data):
+    if not isinstance(data, str):
+        data = bytes(data).decode("utf-8", errors="replace")
+
+    document = BeautifulSoup(data, features="html.parser")
+
+    for element in document(["script", "style"]):
+        element.decompose()
+
+    for element in document.find_all(block_tags):
+        element.insert_before("\n")
+        element.insert_after("\n")
+
+    segments = document.get_text().split("\n")
+
+    for attribute in translatable_attributes:
+        segments.extend(
+            [
+                element[attribute]
+                for element in document.find_all(attrs={attribute: True})
+            ]
+        )
+
+    lines = [" ".join(segment.split()) for segment in segments]
+    text = "\n".join([line for line in lines if len(line) > 0])
+
+    for bad_ch, good_ch in semantic_replacements:
+        text = text.replace(bad_ch, good_ch)
+
+    return get_sha256(text.encode("utf-8"))
+
+
+def get_hash_workers():
+    return int(os.getenv("hash_workers", str(os.cpu_count() or 1)))
+
+
+def hash_file(file_path, digest=get_crc32, strip=False):
+    if not os.path.isfile(file_path):
+        return None
+
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest(b"")
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if strip:
+                return digest(data[:].strip())
+
+            return digest(data)
+
+
+def hash_files(file_paths, digest=get_crc32, strip=False, workers=None):
+    file_paths = list(file_paths)
+
+    if workers is None:
+        workers = get_hash_workers()
+
+    if workers <= 1 or len(file_paths) <= 1:
+        return {
+            file_path: hash_file(file_path, digest, strip) for file_path in file_paths
+        }
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        file_hashes = executor.map(
+            lambda file_path: hash_file(file_path, digest, strip), file_paths
+        )
+
+        return dict(zip(file_paths, file_hashes))
+
+
+def is_semantic_hashing_enabled():
+    return os.getenv("semantic_hashing", "false") == "true"
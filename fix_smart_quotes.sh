@@ -13,21 +13,27 @@ fix_file() {
 update_crc32() {
     return 0
 
-    file=${1}
-
-    if [ ! -f ${file}.crc32 ]; then
-        return
-    fi
+    origin=${1}
+    file=${2}
 
     echo "updating crc32: ${file}"
 
-    python -c "
+    PYTHONPATH=$(dirname $0) python -c "
 import binascii
-import sys
+import hash_manifest
 with open('${file}', 'rb') as f:
-    new_crc32 = str(binascii.crc32(f.read()))
-with open('${file}.crc32', 'w') as f:
-    f.write(new_crc32)
+    new_crc32 = binascii.crc32(f.read())
+hash_manifest.save_hashes('/home/me/dev/translate-learn/${origin}', {'${file}': new_crc32})
+"
+}
+
+remove_crc32() {
+    origin=${1}
+    file=${2}
+
+    PYTHONPATH=$(dirname $0) python -c "
+import hash_manifest
+hash_manifest.delete_hashes('/home/me/dev/translate-learn/${origin}', ['${file}'])
 "
 }
 
@@ -35,12 +41,12 @@ for ch in ‘ ’ '&rsquo;'; do
     for origin in 'learn-uat.liferay.com' 'learn.liferay.com'; do
         for file in $(grep -rFl ${ch} /home/me/dev/translate-learn/${origin}/en/); do
             fix_file ${ch} "'" ${file}
-            update_crc32 ${file}
+            update_crc32 ${origin} ${file}
         done
 
         for file in $(grep -rFl ${ch} /home/me/dev/translate-learn/${origin}/ja/); do
             fix_file ${ch} "" ${file}
-            rm -f ${file}.crc32
+            remove_crc32 ${origin} ${file}
         done
     done
 done
@@ -49,12 +55,12 @@ for ch in “ ” '&ldquo;' '&rdquo'; do
     for origin in 'learn-uat.liferay.com' 'learn.liferay.com'; do
         for file in $(grep -rFl ${ch} /home/me/dev/translate-learn/${origin}/en/); do
             fix_file ${ch} '"' ${file}
-            update_crc32 ${file}
+            update_crc32 ${origin} ${file}
         done
 
         for file in $(grep -rFl ${ch} /home/me/dev/translate-learn/${origin}/ja/); do
             fix_file ${ch} '' ${file}
-            update_crc32 ${file}
+            update_crc32 ${origin} ${file}
         done
     done
 done
\ No newline at end of file
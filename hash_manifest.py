@@ -0,0 +1,487 @@
+from file_hashing import get_semantic_hash, hash_files
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Content hashes of the files in a scratch folder, kept in a single database at
+# the root of that folder rather than in a .crc32 file next to every file. Paths
+# are stored relative to the root, so the manifest moves with its folder.
+#
+# The synced table holds the hash of each file as of its last sync, and the
+# current table caches the hash of each file on disk along with its size and
+# modification time, so that only files whose stat data changed are re-read.
+#
+# When watch_articles.py is running, it records every file that changes in the
+# dirty table, so callers only need to look at those files. Each root should
+# have only one consumer of its dirty files.
+
+manifest_lock = threading.Lock()
+
+schema = [
+    """
+    CREATE TABLE IF NOT EXISTS synced (
+        path TEXT NOT NULL PRIMARY KEY,
+        crc32 TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS current (
+        path TEXT NOT NULL PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        crc32 TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dirty (
+        path TEXT NOT NULL PRIMARY KEY,
+        changed_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS flags (
+        name TEXT NOT NULL,
+        path TEXT NOT NULL,
+        PRIMARY KEY (name, path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS watcher (
+        id INTEGER NOT NULL PRIMARY KEY CHECK (id = 1),
+        pid INTEGER NOT NULL,
+        started_at REAL NOT NULL,
+        heartbeat_at REAL NOT NULL
+    )
+    """,
+]
+
+added_columns = [
+    ("synced", "semantic TEXT"),
+    ("current", "semantic TEXT"),
+]
+
+watcher_heartbeat_seconds = 10
+watcher_max_age_seconds = 30
+
+
+def get_manifest_file(root):
+    return os.path.join(root, ".crc32.db")
+
+
+def get_manifest_path(root, file_path):
+    return os.path.relpath(os.path.join(root, file_path), root).replace(os.sep, "/")
+
+
+def connect(root):
+    connection = sqlite3.connect(get_manifest_file(root), timeout=60)
+
+    for statement in schema:
+        connection.execute(statement)
+
+    for table, column in added_columns:
+        column_names = [
+            row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)
+        ]
+
+        if column.split(" ")[0] not in column_names:
+            connection.execute("ALTER TABLE %s ADD COLUMN %s" % (table, column))
+
+    if connection.execute("PRAGMA user_version").fetchone()[0] == 0:
+        migrate_sidecars(root, connection)
+
+    return connection
+
+
+def migrate_sidecars(root, connection):
+    sidecar_files = []
+
+    for folder, _, file_names in os.walk(root):
+        sidecar_files.extend(
+            [
+                os.path.join(folder, file_name)
+                for file_name in file_names
+                if file_name[-6:] == ".crc32"
+            ]
+        )
+
+    rows = []
+
+    for sidecar_file in sidecar_files:
+        with open(sidecar_file, "r", encoding="utf-8") as f:
+            rows.append((get_manifest_path(root, sidecar_file[:-6]), f.read().strip()))
+
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO synced (path, crc32) VALUES (?, ?)", rows
+        )
+        connection.execute("PRAGMA user_version = 1")
+
+    for sidecar_file in sidecar_files:
+        os.remove(sidecar_file)
+
+    if len(sidecar_files) > 0:
+        logging.info(
+            "Moved %d .crc32 files into %s"
+            % (len(sidecar_files), get_manifest_file(root))
+        )
+
+
+def load_hashes(root, prefix=""):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            "SELECT path, crc32 FROM synced WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+        ).fetchall()
+
+        connection.close()
+
+    return {path: crc32 for path, crc32 in rows}
+
+
+def save_hashes(root, hashes, semantic_hashes=None):
+    if len(hashes) == 0:
+        return
+
+    if semantic_hashes is None:
+        semantic_hashes = {}
+
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.executemany(
+                """
+                INSERT OR REPLACE INTO synced (path, crc32, semantic)
+                VALUES (?, ?, ?)
+                """,
+                [
+                    (
+                        get_manifest_path(root, file_path),
+                        str(crc32),
+                        semantic_hashes.get(file_path),
+                    )
+                    for file_path, crc32 in hashes.items()
+                ],
+            )
+
+        connection.close()
+
+
+def delete_hashes(root, file_paths):
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.executemany(
+                "DELETE FROM synced WHERE path = ?",
+                [(get_manifest_path(root, file_path),) for file_path in file_paths],
+            )
+
+        connection.close()
+
+
+def get_current_hashes(root, file_paths):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            "SELECT path, size, mtime_ns, crc32 FROM current"
+        ).fetchall()
+
+        connection.close()
+
+    cached_hashes = {
+        path: (size, mtime_ns, crc32) for path, size, mtime_ns, crc32 in rows
+    }
+
+    current_hashes = {}
+    changed_stats = {}
+
+    for file_path in file_paths:
+        manifest_path = get_manifest_path(root, file_path)
+        stat = os.stat(os.path.join(root, file_path))
+
+        cached_hash = cached_hashes.get(manifest_path)
+
+        if cached_hash is not None and cached_hash[:2] == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            current_hashes[file_path] = cached_hash[2]
+        else:
+            changed_stats[file_path] = stat
+
+    changed_hashes = hash_files(
+        [os.path.join(root, file_path) for file_path in changed_stats.keys()]
+    )
+
+    changed_rows = []
+
+    for file_path, stat in changed_stats.items():
+        crc32 = changed_hashes[os.path.join(root, file_path)]
+        current_hashes[file_path] = crc32
+
+        changed_rows.append(
+            (
+                get_manifest_path(root, file_path),
+                stat.st_size,
+                stat.st_mtime_ns,
+                crc32,
+            )
+        )
+
+    if len(changed_rows) > 0:
+        logging.info("Hashed %d changed files" % len(changed_rows))
+
+        with manifest_lock:
+            connection = connect(root)
+
+            with connection:
+                connection.executemany(
+                    """
+                    INSERT OR REPLACE INTO current (path, size, mtime_ns, crc32)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    changed_rows,
+                )
+
+            connection.close()
+
+    return current_hashes
+
+
+def load_semantic_hashes(root, prefix=""):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            """
+            SELECT path, semantic FROM synced
+            WHERE substr(path, 1, ?) = ? AND semantic IS NOT NULL
+            """,
+            (len(prefix), prefix),
+        ).fetchall()
+
+        connection.close()
+
+    return {path: semantic for path, semantic in rows}
+
+
+def get_current_semantic_hashes(root, file_paths):
+    file_paths = list(file_paths)
+
+    # Refresh the stat data first, which clears the semantic hash of any file
+    # that changed since it was last computed
+
+    get_current_hashes(root, file_paths)
+
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            "SELECT path, semantic FROM current WHERE semantic IS NOT NULL"
+        ).fetchall()
+
+        connection.close()
+
+    cached_hashes = {path: semantic for path, semantic in rows}
+
+    current_hashes = {}
+    changed_paths = []
+
+    for file_path in file_paths:
+        manifest_path = get_manifest_path(root, file_path)
+
+        if manifest_path in cached_hashes:
+            current_hashes[file_path] = cached_hashes[manifest_path]
+        else:
+            changed_paths.append(file_path)
+
+    changed_hashes = hash_files(
+        [os.path.join(root, file_path) for file_path in changed_paths],
+        get_semantic_hash,
+    )
+
+    for file_path in changed_paths:
+        current_hashes[file_path] = changed_hashes[os.path.join(root, file_path)]
+
+    if len(changed_paths) > 0:
+        with manifest_lock:
+            connection = connect(root)
+
+            with connection:
+                connection.executemany(
+                    "UPDATE current SET semantic = ? WHERE path = ?",
+                    [
+                        (current_hashes[file_path], get_manifest_path(root, file_path))
+                        for file_path in changed_paths
+                    ],
+                )
+
+            connection.close()
+
+    return current_hashes
+
+
+def delete_current(root, file_paths):
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.executemany(
+                "DELETE FROM current WHERE path = ?",
+                [(get_manifest_path(root, file_path),) for file_path in file_paths],
+            )
+
+        connection.close()
+
+
+def load_current_paths(root, prefix=""):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            "SELECT path FROM current WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+        ).fetchall()
+
+        connection.close()
+
+    return [row[0] for row in rows]
+
+
+def load_outdated(root, prefix=""):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            """
+            SELECT current.path FROM current
+            LEFT JOIN synced ON synced.path = current.path
+            WHERE substr(current.path, 1, ?) = ?
+            AND (synced.crc32 IS NULL OR synced.crc32 != current.crc32)
+            """,
+            (len(prefix), prefix),
+        ).fetchall()
+
+        connection.close()
+
+    return [row[0] for row in rows]
+
+
+def mark_dirty(root, file_paths):
+    changed_at = time.time()
+
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO dirty VALUES (?, ?)",
+                [
+                    (get_manifest_path(root, file_path), changed_at)
+                    for file_path in file_paths
+                ],
+            )
+
+        connection.close()
+
+
+def load_dirty(root, prefix=""):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            "SELECT path, changed_at FROM dirty WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+        ).fetchall()
+
+        connection.close()
+
+    return {path: changed_at for path, changed_at in rows}
+
+
+def clear_dirty(root, dirty_files):
+    # Files that changed again after they were loaded stay dirty
+
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.executemany(
+                "DELETE FROM dirty WHERE path = ? AND changed_at = ?",
+                list(dirty_files.items()),
+            )
+
+        connection.close()
+
+
+def load_flags(root, name):
+    with manifest_lock:
+        connection = connect(root)
+
+        rows = connection.execute(
+            "SELECT path FROM flags WHERE name = ?", (name,)
+        ).fetchall()
+
+        connection.close()
+
+    return set([row[0] for row in rows])
+
+
+def save_flags(root, name, added_paths, removed_paths):
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO flags VALUES (?, ?)",
+                [(name, path) for path in added_paths],
+            )
+            connection.executemany(
+                "DELETE FROM flags WHERE name = ? AND path = ?",
+                [(name, path) for path in removed_paths],
+            )
+
+        connection.close()
+
+
+def save_watcher(root, pid, started_at):
+    with manifest_lock:
+        connection = connect(root)
+
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO watcher VALUES (1, ?, ?, ?)",
+                (pid, started_at, time.time()),
+            )
+
+        connection.close()
+
+
+def is_watcher_alive(root):
+    if not os.path.exists(get_manifest_file(root)):
+        return False
+
+    with manifest_lock:
+        connection = connect(root)
+
+        row = connection.execute(
+            "SELECT pid, heartbeat_at FROM watcher WHERE id = 1"
+        ).fetchone()
+
+        connection.close()
+
+    if row is None or time.time() - row[1] > watcher_max_age_seconds:
+        return False
+
+    try:
+        os.kill(row[0], 0)
+    except OSError:
+        return False
+
+    return True
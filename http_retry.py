@@ -0,0 +1,215 @@
+from email.utils import parsedate_to_datetime
+import logging
+import os
+import random
+import requests
+import threading
+import time
+from urllib.parse import urlparse
+import urllib3
+
+# Retry policy shared by the Crowdin, Zendesk and Liferay clients. Requests are
+# grouped by host: each host gets its own concurrency limit, rate limit window
+# and circuit breaker.
+
+max_attempts = 6
+base_delay = 1.0
+max_delay = 60.0
+
+retry_status_codes = [429, 500, 502, 503, 504]
+
+# Requests with other methods might have been carried out even if we never saw
+# the response, so they are only retried when the server could not have acted
+# on them: rate limited, or the connection was never established.
+
+idempotent_methods = ["DELETE", "GET", "HEAD", "OPTIONS"]
+
+concurrency_limits = {
+    "api.crowdin.com": 20,
+}
+
+default_concurrency_limit = 10
+
+circuit_failure_threshold = 5
+circuit_reset_seconds = 30.0
+
+endpoint_states = {}
+endpoint_states_lock = threading.Lock()
+
+
+def get_endpoint(url):
+    return urlparse(url).netloc
+
+
+def get_endpoint_state(endpoint):
+    with endpoint_states_lock:
+        if endpoint not in endpoint_states:
+            concurrency_limit = (
+                concurrency_limits[endpoint]
+                if endpoint in concurrency_limits
+                else default_concurrency_limit
+            )
+
+            endpoint_states[endpoint] = {
+                "lock": threading.Lock(),
+                "semaphore": threading.BoundedSemaphore(concurrency_limit),
+                "failures": 0,
+                "opened_at": None,
+                "not_before": 0.0,
+            }
+
+        return endpoint_states[endpoint]
+
+
+def get_timeout():
+    return (
+        float(os.getenv("http_connect_timeout", "10")),
+        float(os.getenv("http_read_timeout", "120")),
+    )
+
+
+def is_connect_error(e):
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    if not isinstance(e, requests.exceptions.ConnectionError) or len(e.args) == 0:
+        return False
+
+    reason = getattr(e.args[0], "reason", e.args[0])
+
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def get_backoff_delay(attempt):
+    return random.uniform(0, min(max_delay, base_delay * (2**attempt)))
+
+
+def get_header_delay(value):
+    if value is None:
+        return None
+
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    # Some APIs report an epoch timestamp rather than a number of seconds
+
+    if delay > 1000000000:
+        delay = delay - time.time()
+
+    return max(0.0, delay)
+
+
+def get_retry_delay(r, attempt):
+    delay = get_header_delay(r.headers.get("Retry-After"))
+
+    if delay is None and r.headers.get("X-RateLimit-Remaining") == "0":
+        delay = get_header_delay(r.headers.get("X-RateLimit-Reset"))
+
+    if delay is None:
+        return get_backoff_delay(attempt)
+
+    return min(max_delay, delay) + random.uniform(0, base_delay)
+
+
+def update_rate_limit(state, r):
+    if r.headers.get("X-RateLimit-Remaining") != "0":
+        return
+
+    delay = get_header_delay(r.headers.get("X-RateLimit-Reset"))
+
+    if delay is None:
+        return
+
+    with state["lock"]:
+        state["not_before"] = max(state["not_before"], time.time() + delay)
+
+
+def record_failure(endpoint, state):
+    with state["lock"]:
+        state["failures"] = state["failures"] + 1
+
+        if state["failures"] >= circuit_failure_threshold:
+            if state["opened_at"] is None:
+                logging.warning("Circuit opened for %s" % endpoint)
+
+            state["opened_at"] = time.time()
+
+
+def record_success(endpoint, state):
+    with state["lock"]:
+        if state["opened_at"] is not None:
+            logging.info("Circuit closed for %s" % endpoint)
+
+        state["failures"] = 0
+        state["opened_at"] = None
+
+
+def wait_for_endpoint(state):
+    with state["lock"]:
+        wait_until = state["not_before"]
+
+        if state["opened_at"] is not None:
+            wait_until = max(wait_until, state["opened_at"] + circuit_reset_seconds)
+
+    delay = wait_until - time.time()
+
+    if delay > 0:
+        time.sleep(delay)
+
+
+def send_request(url, send, method="GET", idempotent=None):
+    endpoint = get_endpoint(url)
+    state = get_endpoint_state(endpoint)
+
+    if idempotent is None:
+        idempotent = method in idempotent_methods
+
+    for attempt in range(max_attempts):
+        wait_for_endpoint(state)
+
+        try:
+            with state["semaphore"]:
+                r = send()
+        except requests.exceptions.RequestException as e:
+            record_failure(endpoint, state)
+
+            if attempt == max_attempts - 1 or not (idempotent or is_connect_error(e)):
+                raise
+
+            delay = get_backoff_delay(attempt)
+
+            logging.warning(
+                "Exception requesting URL %s (%s), retrying in %.1f seconds"
+                % (url, e.__class__.__name__, delay)
+            )
+
+            time.sleep(delay)
+            continue
+
+        update_rate_limit(state, r)
+
+        if r.status_code not in retry_status_codes:
+            record_success(endpoint, state)
+            return r
+
+        if r.status_code >= 500:
+            record_failure(endpoint, state)
+
+        if attempt == max_attempts - 1 or not (idempotent or r.status_code == 429):
+            return r
+
+        delay = get_retry_delay(r, attempt)
+
+        logging.warning(
+            "HTTP %d requesting URL %s, retrying in %.1f seconds"
+            % (r.status_code, url, delay)
+        )
+
+        time.sleep(delay)
+
+    return r
@@ -4,19 +4,27 @@ import binascii
 
 from bs4 import BeautifulSoup
 from crowdin import (
+    crowdin_delete_files,
     crowdin_download_translations,
     crowdin_upload_sources,
-    extract_crowdin_translation,
     pre_translate,
 )
 from crowdin_util import (
     crowdin_request,
+    get_crowdin_file_info,
+    get_crowdin_request_count,
     get_directory,
     get_repository,
     get_repository_state,
+    invalidate_crowdin_file_info,
+    remove_directory_index_entries,
 )
 import datetime
 from dotenv import load_dotenv
+from file_hashing import get_semantic_hash, is_semantic_hashing_enabled
+import hash_manifest
+import heapq
+from http_retry import get_timeout, send_request
 import json
 import logging
 import os
@@ -24,6 +32,7 @@ import requests
 from session import session
 from session import save_session
 import sys
+import time
 
 batch_size = 200
 
@@ -38,6 +47,9 @@ client_id = os.getenv("client_id")
 client_secret = os.getenv("client_secret")
 learn_group_id = os.getenv("learn_group_id")
 learn_scratch_dir = os.getenv("learn_scratch_dir")
+sync_mode = os.getenv("crowdin_sync_mode", "incremental")
+drain_time_budget = int(os.getenv("drain_time_budget", "10800"))
+drain_api_budget = int(os.getenv("drain_api_budget", "0"))
 
 learn_url = (
     f"http://{learn_domain}"
@@ -93,7 +105,7 @@ def authorize():
     }
 
 
-def copy_crowdin_to_local(source_language, target_language):
+def copy_crowdin_to_local(source_language, target_language, reuse_recent_build=True):
     repository = get_repository(learn_domain)
 
     _, file_info = get_repository_state(repository, target_language[:2])
@@ -101,15 +113,12 @@ def copy_crowdin_to_local(source_language, target_language):
     old_dir = os.getcwd()
     os.chdir(learn_scratch_dir)
 
-    export_file_name = crowdin_download_translations(
+    crowdin_download_translations(
         repository,
         source_language[:2],
         target_language[:2],
         file_info,
-    )
-
-    extract_crowdin_translation(
-        repository, export_file_name, source_language[:2], target_language[:2]
+        reuse_recent_build=reuse_recent_build,
     )
 
     os.chdir(old_dir)
@@ -217,31 +226,24 @@ def copy_learn_web_content_to_local(language):
         f.write(last_search_time)
 
 
-def copy_local_to_crowdin(source_language, target_language):
+def copy_local_to_crowdin(source_language, target_language, outdated_web_content_articles=None):
     repository = get_repository(learn_domain)
 
-    outdated_web_content_articles = check_outdated_articles(source_language, 'web_content')
+    if outdated_web_content_articles is None:
+        outdated_web_content_articles = check_outdated_articles(source_language, 'web_content')
+
     language_folder = "%s/%s/%s" % (learn_scratch_dir, source_language[:2], 'web_content')
 
     old_dir = os.getcwd()
     os.chdir("%s/%s" % (learn_scratch_dir, source_language[:2]))
 
-    crowdin_directory = get_directory(repository, "", False)
-
-    if crowdin_directory is not None:
-        delete_url = "/projects/%s/directories/%s" % (
-            repository.project_id,
-            crowdin_directory["id"],
-        )
-
-        logging.info("Deleting directory containing past translations (this takes awhile)")
-
-        status_code, response_data = crowdin_request(delete_url, "DELETE")
-
-        logging.error(status_code)
-        logging.error(response_data)
+    if sync_mode == "replace":
+        delete_crowdin_directory(repository)
+    else:
+        delete_removed_crowdin_files(repository, target_language)
 
     if len(outdated_web_content_articles) == 0:
+        os.chdir(old_dir)
         return False
 
     crowdin_upload_sources(
@@ -253,6 +255,63 @@ def copy_local_to_crowdin(source_language, target_language):
     return True
 
 
+def delete_crowdin_directory(repository):
+    crowdin_directory = get_directory(repository, "", False)
+
+    if crowdin_directory is None:
+        return
+
+    delete_url = "/projects/%s/directories/%s" % (
+        repository.project_id,
+        crowdin_directory["id"],
+    )
+
+    logging.info("Deleting directory containing past translations (this takes awhile)")
+
+    status_code, response_data = crowdin_request(delete_url, "DELETE")
+
+    logging.error(status_code)
+    logging.error(response_data)
+
+    remove_directory_index_entries(repository, "")
+    invalidate_crowdin_file_info(repository)
+
+
+def delete_removed_crowdin_files(repository, target_language):
+    file_info = get_crowdin_file_info(repository, target_language[:2])
+
+    removed_file_ids = [
+        metadata["id"]
+        for crowdin_file, metadata in file_info.items()
+        if not os.path.exists(crowdin_file[len(repository.dest_folder) + 1 :])
+    ]
+
+    logging.info(
+        "%d/%d files on crowdin no longer exist locally"
+        % (len(removed_file_ids), len(file_info))
+    )
+
+    # A partial restore of the scratch folder looks the same as a mass removal
+    # of articles, so refuse to delete a large share of the files on Crowdin,
+    # since their translations would be lost along with them
+
+    max_delete_count = int(os.getenv("crowdin_max_delete_count", "50"))
+    max_delete_ratio = float(os.getenv("crowdin_max_delete_ratio", "0.1"))
+
+    if (
+        len(removed_file_ids) > max_delete_count
+        and len(removed_file_ids) > max_delete_ratio * len(file_info)
+    ):
+        logging.error(
+            "Refusing to delete %d/%d files from crowdin, check that %s is complete "
+            "or raise crowdin_max_delete_count"
+            % (len(removed_file_ids), len(file_info), os.getcwd())
+        )
+        return
+
+    crowdin_delete_files(repository, removed_file_ids)
+
+
 def load_web_content_titles(source_language, target_language):
     web_content_titles = {}
 
@@ -309,34 +368,220 @@ def check_outdated_articles(language, subfolder):
 
         return outdated_articles
 
-    for html_file_name in [x for x in os.listdir(language_folder) if x[-5:] == ".html"]:
-        if learn_domain.find("localhost") != -1:
-            outdated_articles.append(os.path.join(subfolder, html_file_name))
-            continue
+    if learn_domain.find("localhost") == -1 and hash_manifest.is_watcher_alive(
+        learn_scratch_dir
+    ):
+        outdated_articles = check_watched_outdated_articles(language, subfolder)
+        print(len(outdated_articles), "out of date files")
+
+        return outdated_articles
+
+    old_hashes = hash_manifest.load_hashes(
+        learn_scratch_dir, "%s/%s/" % (language[:2], subfolder)
+    )
 
-        html_file = "%s/%s" % (language_folder, html_file_name)
-        hash_file = "%s.crc32" % html_file
+    html_file_names = [x for x in os.listdir(language_folder) if x[-5:] == ".html"]
 
-        if not os.path.exists(hash_file):
-            print('missing hash %s' % hash_file)
+    if learn_domain.find("localhost") != -1:
+        outdated_articles = [os.path.join(subfolder, x) for x in html_file_names]
+        print(len(outdated_articles), "out of date files")
+
+        return outdated_articles
+
+    hash_keys = {}
+
+    for html_file_name in html_file_names:
+        hash_key = "%s/%s/%s" % (language[:2], subfolder, html_file_name)
+
+        if hash_key not in old_hashes:
+            print('missing hash %s' % hash_key)
             outdated_articles.append(os.path.join(subfolder, html_file_name))
             continue
 
-        with open(hash_file, "r", encoding="utf-8") as f:
-            old_hash = f.read()
+        hash_keys[hash_key] = html_file_name
 
-        with open(html_file, "rb") as f:
-            new_hash = str(binascii.crc32(f.read()))
+    new_hashes = hash_manifest.get_current_hashes(learn_scratch_dir, hash_keys.keys())
 
-        if old_hash != new_hash:
-            print('mismatched hash %s' % hash_file)
-            outdated_articles.append(os.path.join(subfolder, html_file_name))
+    mismatched_keys = [
+        hash_key
+        for hash_key in hash_keys.keys()
+        if old_hashes[hash_key] != new_hashes[hash_key]
+    ]
+
+    markup_only_keys = get_markup_only_changes(language, subfolder, mismatched_keys)
+
+    for hash_key in mismatched_keys:
+        if hash_key in markup_only_keys:
+            print('markup-only change %s' % hash_key)
+            continue
+
+        print('mismatched hash %s' % hash_key)
+        outdated_articles.append(os.path.join(subfolder, hash_keys[hash_key]))
 
     print(len(outdated_articles), "out of date files")
 
     return outdated_articles
 
 
+def check_watched_outdated_articles(language, subfolder):
+    # watch_articles.py keeps track of which files changed, so only those need
+    # to be hashed before comparing the manifest against itself
+
+    prefix = "%s/%s/" % (language[:2], subfolder)
+
+    dirty_files = hash_manifest.load_dirty(learn_scratch_dir, prefix)
+
+    existing_files = [
+        path
+        for path in dirty_files.keys()
+        if os.path.isfile(os.path.join(learn_scratch_dir, path))
+    ]
+
+    hash_manifest.get_current_hashes(learn_scratch_dir, existing_files)
+
+    hash_manifest.delete_current(
+        learn_scratch_dir,
+        [path for path in dirty_files.keys() if path not in existing_files],
+    )
+
+    hash_manifest.clear_dirty(learn_scratch_dir, dirty_files)
+
+    outdated_paths = [
+        path
+        for path in sorted(hash_manifest.load_outdated(learn_scratch_dir, prefix))
+        if path[-5:] == ".html" and path.find("/", len(prefix)) == -1
+    ]
+
+    markup_only_paths = get_markup_only_changes(language, subfolder, outdated_paths)
+
+    outdated_articles = []
+
+    for path in outdated_paths:
+        if path in markup_only_paths:
+            print('markup-only change %s' % path)
+            continue
+
+        print('outdated hash %s' % path)
+        outdated_articles.append(os.path.join(subfolder, path[len(prefix) :]))
+
+    return outdated_articles
+
+
+def get_markup_only_changes(language, subfolder, hash_keys):
+    # With semantic hashing enabled, files whose translatable text is unchanged
+    # since the last sync do not need to go through Crowdin again
+
+    if not is_semantic_hashing_enabled() or len(hash_keys) == 0:
+        return set()
+
+    old_hashes = hash_manifest.load_semantic_hashes(
+        learn_scratch_dir, "%s/%s/" % (language[:2], subfolder)
+    )
+
+    new_hashes = hash_manifest.get_current_semantic_hashes(
+        learn_scratch_dir,
+        [hash_key for hash_key in hash_keys if hash_key in old_hashes],
+    )
+
+    return set(
+        [
+            hash_key
+            for hash_key, semantic_hash in new_hashes.items()
+            if semantic_hash == old_hashes[hash_key]
+        ]
+    )
+
+
+def get_article_queue_file():
+    return "%s/.outdated_queue.json" % learn_scratch_dir
+
+
+def load_article_queue():
+    if not os.path.exists(get_article_queue_file()):
+        return []
+
+    with open(get_article_queue_file(), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_article_queue(article_queue):
+    with open(get_article_queue_file(), "w", encoding="utf-8") as f:
+        json.dump(article_queue, f)
+
+
+def refresh_article_queue(source_language):
+    outdated_web_content_articles = check_outdated_articles(source_language, 'web_content')
+    language_folder = "%s/%s" % (learn_scratch_dir, source_language[:2])
+
+    article_queue = [
+        entry for entry in load_article_queue()
+        if entry[2] in outdated_web_content_articles
+    ]
+
+    queued_articles = set([entry[2] for entry in article_queue])
+
+    for html_file in outdated_web_content_articles:
+        if html_file in queued_articles:
+            continue
+
+        json_file = "%s/%s.json" % (language_folder, html_file[:-5])
+        date_modified = ""
+
+        if os.path.exists(json_file):
+            with open(json_file, "r", encoding="utf-8") as f:
+                date_modified = json.load(f)["dateModified"]
+
+        size = os.path.getsize(os.path.join(language_folder, html_file))
+
+        article_queue.append([date_modified, size, html_file])
+
+    heapq.heapify(article_queue)
+    save_article_queue(article_queue)
+
+    return article_queue
+
+
+def drain_outdated_articles(source_language, target_language):
+    start_time = time.time()
+    start_request_count = get_crowdin_request_count()
+
+    article_queue = refresh_article_queue(source_language)
+
+    while len(article_queue) > 0:
+        elapsed_time = time.time() - start_time
+        request_count = get_crowdin_request_count() - start_request_count
+
+        if drain_time_budget > 0 and elapsed_time > drain_time_budget:
+            logging.info("Stopping after %d seconds (time budget exhausted)" % elapsed_time)
+            break
+
+        if drain_api_budget > 0 and request_count > drain_api_budget:
+            logging.info("Stopping after %d requests (API budget exhausted)" % request_count)
+            break
+
+        batch = [
+            heapq.heappop(article_queue)[2]
+            for i in range(min(batch_size, len(article_queue)))
+        ]
+
+        logging.info(
+            "Processing batch of %d articles (%d remaining in queue)"
+            % (len(batch), len(article_queue))
+        )
+
+        copy_local_to_crowdin(source_language, target_language, batch)
+        translate_learn_on_crowdin(source_language, target_language)
+        # A build from an earlier batch would not include the translations
+        # that were just made, so always ask for a new one
+
+        copy_crowdin_to_local(source_language, target_language, False)
+        copy_local_to_learn(source_language, target_language)
+
+        save_article_queue(article_queue)
+
+    logging.info("%d articles remain in the queue" % len(article_queue))
+
+
 def make_headless_list_request(url, accept_language, initial_params):
     params = initial_params.copy()
 
@@ -375,14 +620,22 @@ def make_headless_request(url, method, accept_language, data):
     headless_headers["Accept-Language"] = accept_language
 
     if method == "GET":
-        r = session.get(url, params=data, headers=headless_headers)
+        send = lambda: session.get(
+            url, params=data, headers=headless_headers, timeout=get_timeout()
+        )
     elif method == "PATCH":
-        r = requests.patch(url, json=data, headers=headless_headers)
+        send = lambda: requests.patch(
+            url, json=data, headers=headless_headers, timeout=get_timeout()
+        )
     elif method == "PUT":
-        r = requests.put(url, json=data, headers=headless_headers)
+        send = lambda: requests.put(
+            url, json=data, headers=headless_headers, timeout=get_timeout()
+        )
     else:
         raise Exception("Unrecognized method: %s" % method)
 
+    r = send_request(url, send, method)
+
     print(f"{method} {url} ({r.status_code})")
 
     try:
@@ -430,8 +683,16 @@ def publish_translated_web_content_article(article_id, source_language, target_l
 
     if status_code == 200:
         if learn_domain.find("localhost") == -1:
-            with open("%s.crc32" % html_file, "w", encoding="utf-8") as f:
-                f.write(str(binascii.crc32(html_content.encode("utf-8"))))
+            semantic_hashes = {}
+
+            if is_semantic_hashing_enabled():
+                semantic_hashes[html_file] = get_semantic_hash(html_content)
+
+            hash_manifest.save_hashes(
+                learn_scratch_dir,
+                {html_file: binascii.crc32(html_content.encode("utf-8"))},
+                semantic_hashes,
+            )
     else:
         print(
             "failed to publish %s (status code: %d, data: %s)"
@@ -544,5 +805,8 @@ if __name__ == "__main__":
 
         if "copy_local_to_learn" in actions:
             copy_local_to_learn("en-US", "ja-JP")
+
+        if "drain_outdated_articles" in actions:
+            drain_outdated_articles("en-US", "ja-JP")
     finally:
         save_session()
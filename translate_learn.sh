@@ -80,7 +80,8 @@ copy_learn_to_local
 copy_local_to_crowdin
 translate_learn_on_crowdin
 copy_crowdin_to_local
-copy_local_to_learn" | fzf --query="${1}" --select-1
+copy_local_to_learn
+drain_outdated_articles" | fzf --query="${1}" --select-1
 )
 
 if [ "" != "${ACTION}" ]; then
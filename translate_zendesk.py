@@ -10,7 +10,16 @@ from crowdin_util import (
     initial_dir,
 )
 from datetime import datetime
+from file_hashing import (
+    get_semantic_hash,
+    get_sha256,
+    hash_file,
+    hash_files,
+    is_semantic_hashing_enabled,
+)
 import git
+import hash_manifest
+from http_retry import get_timeout, send_request
 import json
 import logging
 import math
@@ -110,34 +119,67 @@ def requires_new_english_translation(utf8_string):
     return False
 
 
+def get_english_file_paths():
+    if not hash_manifest.is_watcher_alive(os.getcwd()):
+        return [
+            os.path.join(subdir, en_file)
+            for subdir, dirs, en_files in os.walk("en/")
+            for en_file in en_files
+        ]
+
+    # watch_articles.py keeps track of which files changed, so only those need
+    # to be checked again for Japanese text
+
+    root = os.getcwd()
+    dirty_files = hash_manifest.load_dirty(root, "en/")
+    flagged_paths = hash_manifest.load_flags(root, "requires_new_english_translation")
+
+    added_paths = []
+    removed_paths = []
+
+    for en_file_path in dirty_files.keys():
+        if os.path.isfile(en_file_path):
+            with codecs.open(en_file_path, "r", "utf-8") as f:
+                if requires_new_english_translation(f.read()):
+                    added_paths.append(en_file_path)
+                    continue
+
+        removed_paths.append(en_file_path)
+
+    hash_manifest.save_flags(
+        root, "requires_new_english_translation", added_paths, removed_paths
+    )
+    hash_manifest.clear_dirty(root, dirty_files)
+
+    return sorted(flagged_paths.union(added_paths).difference(removed_paths))
+
+
 def retranslate_ja_to_en():
     article_paths = {}
 
-    for subdir, dirs, en_files in os.walk("en/"):
-        for en_file in en_files:
-            en_file_path = os.path.join(subdir, en_file)
-            ja_file_path = "ja/" + en_file_path[3:]
+    for en_file_path in get_english_file_paths():
+        ja_file_path = "ja/" + en_file_path[3:]
 
-            if not os.path.exists(ja_file_path):
-                continue
+        if not os.path.exists(ja_file_path):
+            continue
 
-            with codecs.open(en_file_path, "r", "utf-8") as f:
-                en_content = f.read()
+        with codecs.open(en_file_path, "r", "utf-8") as f:
+            en_content = f.read()
 
-            if not requires_new_english_translation(en_content):
-                continue
+        if not requires_new_english_translation(en_content):
+            continue
 
-            x = ja_file_path.rfind("/")
-            y = ja_file_path.find("-", x)
+        x = ja_file_path.rfind("/")
+        y = ja_file_path.find("-", x)
 
-            article_paths[ja_file_path[x + 1 : y]] = ja_file_path
+        article_paths[ja_file_path[x + 1 : y]] = ja_file_path
 
-            with codecs.open(ja_file_path, "r", "utf-8") as f:
-                ja_content = prepare_japanese_for_translation(f.read())
+        with codecs.open(ja_file_path, "r", "utf-8") as f:
+            ja_content = prepare_japanese_for_translation(f.read())
 
-            with codecs.open(ja_file_path, "w", "utf-8") as f:
-                f.write(ja_content)
-                print(ja_file_path)
+        with codecs.open(ja_file_path, "w", "utf-8") as f:
+            f.write(ja_content)
+            print(ja_file_path)
 
     return article_paths
 
@@ -186,7 +228,7 @@ def zendesk_get_request(domain, api_path, attribute_name, params=None):
 
         logging.info(url)
 
-        r = session.get(url)
+        r = send_request(url, lambda: session.get(url, timeout=get_timeout()))
 
         try:
             api_result = json.loads(r.text)
@@ -226,14 +268,20 @@ def zendesk_json_request(domain, api_path, attribute_name, request_type, json_pa
     logging.info(url)
 
     if request_type == "POST":
-        r = session.post(url, headers=auth_headers, json=json_params)
+        send = lambda: session.post(
+            url, headers=auth_headers, json=json_params, timeout=get_timeout()
+        )
     elif request_type == "PUT":
-        r = session.put(url, headers=auth_headers, json=json_params)
+        send = lambda: session.put(
+            url, headers=auth_headers, json=json_params, timeout=get_timeout()
+        )
     elif request_type == "GET" and json_params is None:
-        r = session.get(url, headers=auth_headers)
+        send = lambda: session.get(url, headers=auth_headers, timeout=get_timeout())
     else:
         return None
 
+    r = send_request(url, send, request_type)
+
     try:
         api_result = json.loads(r.text)
     except:
@@ -517,12 +565,12 @@ def copy_crowdin_to_zendesk(
 
 
 def translate_zendesk_on_crowdin(repository, domain, source_language, target_language):
-    all_files, file_info = get_repository_state(repository, target_language)
+    _, file_info = get_repository_state(repository, target_language)
 
     pre_translate(repository, source_language[:2], target_language[:2])
 
     crowdin_download_translations(
-        repository, source_language, target_language, all_files, file_info
+        repository, source_language, target_language, file_info
     )
 
     old_dir = os.getcwd()
@@ -825,6 +873,34 @@ def download_zendesk_articles(
                 line.strip(): articles[line.strip()] for line in f.readlines()
             }
     else:
+        source_hashes = hash_files(
+            [
+                article_paths[article_id]
+                for article_id in articles.keys()
+                if article_id in article_paths
+            ],
+            get_sha256,
+            True,
+        )
+
+        # Look up the semantic hashes of every mismatched article at once,
+        # rather than reading the manifest again for each article
+
+        semantic_hashes = None
+
+        if is_semantic_hashing_enabled():
+            semantic_hashes = hash_manifest.get_current_semantic_hashes(
+                repository.git_root,
+                [
+                    article_paths[article_id]
+                    for article_id, article in articles.items()
+                    if article_id in article_paths
+                    and source_hashes.get(article_paths[article_id]) is not None
+                    and source_hashes[article_paths[article_id]]
+                    != get_sha256(get_article_content(article).encode("utf-8"))
+                ],
+            )
+
         refresh_articles = {
             article_id: article
             for article_id, article in sorted(articles.items())
@@ -837,6 +913,8 @@ def download_zendesk_articles(
                 article_paths[article_id],
                 None,
                 fetch_update,
+                source_hashes,
+                semantic_hashes,
             )
         }
 
@@ -919,6 +997,22 @@ def remove_nbsp(content):
     return new_content
 
 
+def get_article_content(article):
+    return "<h1>%s</h1>\n%s" % (article["title"], remove_nbsp(article["body"]))
+
+
+def is_markup_only_change(repository, source_file, new_content, semantic_hashes=None):
+    if not is_semantic_hashing_enabled():
+        return False
+
+    if semantic_hashes is None or source_file not in semantic_hashes:
+        semantic_hashes = hash_manifest.get_current_semantic_hashes(
+            repository.git_root, [source_file]
+        )
+
+    return semantic_hashes[source_file] == get_semantic_hash(new_content)
+
+
 def requires_update(
     repository,
     domain,
@@ -928,6 +1022,8 @@ def requires_update(
     source_file,
     target_file,
     fetch_update,
+    source_hashes=None,
+    semantic_hashes=None,
 ):
     # check if machine translation is needed
 
@@ -966,14 +1062,25 @@ def requires_update(
 
     # check if the source target_language was changed
 
-    with open(source_file, "r") as f:
-        old_content = "".join(f.readlines()).strip()
+    if source_hashes is not None and source_file in source_hashes:
+        old_hash = source_hashes[source_file]
+    else:
+        old_hash = hash_file(source_file, get_sha256, True)
 
-    new_content = "<h1>%s</h1>\n%s" % (article["title"], remove_nbsp(article["body"]))
+    new_content = get_article_content(article)
 
-    if old_content != new_content:
-        logging.info("%s (requires update check: mismatched content)" % article["id"])
-        return True
+    if old_hash != get_sha256(new_content.encode("utf-8")):
+        if is_markup_only_change(
+            repository, source_file, new_content, semantic_hashes
+        ):
+            logging.info(
+                "%s (requires update check: markup-only change)" % article["id"]
+            )
+        else:
+            logging.info(
+                "%s (requires update check: mismatched content)" % article["id"]
+            )
+            return True
 
     # check if it's missing a disclaimer
 
@@ -0,0 +1,237 @@
+from bs4 import BeautifulSoup
+import hashlib
+import logging
+import os
+from session import initial_dir
+import sqlite3
+import threading
+
+# Segment-level translation memory harvested from Crowdin exports. Segments are
+# the innermost block elements of each article, keyed by a hash of their
+# whitespace-normalized text.
+
+memory_file = "%s/translation_memory.db" % initial_dir
+memory_lock = threading.Lock()
+
+segment_tags = [
+    "blockquote",
+    "caption",
+    "dd",
+    "dt",
+    "figcaption",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "li",
+    "p",
+    "td",
+    "th",
+]
+
+
+def connect():
+    connection = sqlite3.connect(memory_file, timeout=60)
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS segments (
+            source_language TEXT NOT NULL,
+            target_language TEXT NOT NULL,
+            source_hash TEXT NOT NULL,
+            source_text TEXT NOT NULL,
+            target_text TEXT NOT NULL,
+            PRIMARY KEY (source_language, target_language, source_hash)
+        )
+        """
+    )
+
+    return connection
+
+
+def normalize_text(text):
+    return " ".join(text.replace("\xa0", " ").split())
+
+
+def get_text_hash(text):
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def get_segments(html_content):
+    document = BeautifulSoup(html_content, features="html.parser")
+
+    segments = []
+
+    for element in document.find_all(segment_tags):
+        if element.find(segment_tags) is not None:
+            continue
+
+        if element.find_parent(["code", "pre"]) is not None:
+            continue
+
+        text = normalize_text(element.get_text())
+
+        if len(text) == 0:
+            continue
+
+        segments.append((text, element.decode_contents().strip()))
+
+    return segments
+
+
+def get_segment_rows(source_content, target_content, source_language, target_language):
+    source_segments = get_segments(source_content)
+    target_segments = get_segments(target_content)
+
+    # Crowdin keeps the markup of the source, so segments only line up when
+    # both sides have the same structure
+
+    if len(source_segments) != len(target_segments):
+        return None
+
+    rows = {}
+
+    for (source_text, source_html), (target_text, target_html) in zip(
+        source_segments, target_segments
+    ):
+        if source_text == target_text:
+            continue
+
+        rows[get_text_hash(source_text)] = (
+            source_language,
+            target_language,
+            get_text_hash(source_text),
+            source_text,
+            target_html,
+        )
+
+    return rows
+
+
+def save_segment_rows(rows):
+    with memory_lock:
+        connection = connect()
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)",
+                list(rows.values()),
+            )
+
+        connection.close()
+
+
+def harvest_export(zipdata, source_language, target_language, source_names=None):
+    source_file_prefix = "%s/" % source_language
+    target_file_prefix = "%s/" % target_language
+
+    entry_names = set([zipinfo.filename for zipinfo in zipdata.infolist()])
+
+    if source_names is None:
+        source_names = entry_names
+
+    rows = {}
+    file_count = 0
+
+    for source_name in source_names:
+        if source_name.find(source_file_prefix) != 0 or source_name[-5:] != ".html":
+            continue
+
+        target_name = target_file_prefix + source_name[len(source_file_prefix) :]
+
+        if target_name not in entry_names:
+            continue
+
+        file_rows = get_segment_rows(
+            zipdata.read(source_name).decode("utf-8"),
+            zipdata.read(target_name).decode("utf-8"),
+            source_language,
+            target_language,
+        )
+
+        if file_rows is None:
+            continue
+
+        file_count = file_count + 1
+        rows.update(file_rows)
+
+    save_segment_rows(rows)
+
+    logging.info(
+        "Saved %d segments from %d files to the local translation memory"
+        % (len(rows), file_count)
+    )
+
+
+def harvest_file(source_content, target_content, source_language, target_language):
+    rows = get_segment_rows(
+        source_content.decode("utf-8"),
+        target_content.decode("utf-8"),
+        source_language,
+        target_language,
+    )
+
+    if rows is None:
+        return 0
+
+    save_segment_rows(rows)
+
+    return len(rows)
+
+
+def find_matches(source_language, target_language, texts):
+    text_hashes = {get_text_hash(text): text for text in texts}
+
+    matches = {}
+
+    with memory_lock:
+        connection = connect()
+
+        for source_hash in text_hashes.keys():
+            row = connection.execute(
+                """
+                SELECT target_text FROM segments
+                WHERE source_language = ? AND target_language = ? AND source_hash = ?
+                """,
+                (source_language, target_language, source_hash),
+            ).fetchone()
+
+            if row is not None:
+                matches[text_hashes[source_hash]] = row[0]
+
+        connection.close()
+
+    return matches
+
+
+def report_matches(files, source_language, target_language):
+    total_count = 0
+    total_match_count = 0
+
+    for file in files:
+        if not os.path.exists(file):
+            continue
+
+        with open(file, "r", encoding="utf-8") as f:
+            texts = [text for text, html in get_segments(f.read())]
+
+        matches = find_matches(source_language, target_language, texts)
+        match_count = len([text for text in texts if text in matches])
+
+        total_count = total_count + len(texts)
+        total_match_count = total_match_count + match_count
+
+        if match_count > 0:
+            logging.info(
+                "%d/%d segments have local translation memory matches (%s)"
+                % (match_count, len(texts), file)
+            )
+
+    logging.info(
+        "%d/%d segments across %d files have local translation memory matches"
+        % (total_match_count, total_count, len(files))
+    )
+
+    return total_match_count, total_count
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import hash_manifest
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+# Watch the en/ and ja/ folders underneath a root folder with inotify and
+# record every file that changes in the hash manifest of that root, so that
+# check_outdated_articles and retranslate_ja_to_en only need to look at those
+# files. Only available on Linux, for example:
+#
+#   python watch_articles.py /home/me/dev/translate-learn/learn.liferay.com
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+watch_mask = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+
+event_header = struct.Struct("iIII")
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def add_watches(fd, watched_folders, folder):
+    file_paths = []
+
+    for parent, _, file_names in os.walk(folder):
+        wd = libc.inotify_add_watch(fd, os.fsencode(parent), watch_mask)
+
+        if wd < 0:
+            logging.error(
+                "Unable to watch %s: %s" % (parent, os.strerror(ctypes.get_errno()))
+            )
+            continue
+
+        watched_folders[wd] = parent
+        file_paths.extend([os.path.join(parent, file_name) for file_name in file_names])
+
+    return file_paths
+
+
+def add_all_watches(fd, root, folders):
+    watched_folders = {}
+    file_paths = set()
+
+    for folder in folders:
+        folder_path = os.path.join(root, folder)
+
+        if os.path.isdir(folder_path):
+            file_paths.update(add_watches(fd, watched_folders, folder_path))
+
+        # Files deleted while nobody was watching only exist in the manifest
+
+        prefix = "%s/" % hash_manifest.get_manifest_path(root, folder)
+
+        file_paths.update(
+            [
+                os.path.join(root, path)
+                for path in hash_manifest.load_current_paths(root, prefix)
+            ]
+        )
+
+    # Anything could have changed while nobody was watching, so every file
+    # starts out dirty
+
+    hash_manifest.mark_dirty(root, file_paths)
+
+    logging.info(
+        "Watching %d folders with %d files underneath %s"
+        % (len(watched_folders), len(file_paths), root)
+    )
+
+    return watched_folders
+
+
+def read_events(fd, watched_folders):
+    buffer = os.read(fd, 65536)
+    offset = 0
+
+    changed_paths = set()
+    new_folders = []
+    overflow = False
+
+    while offset < len(buffer):
+        wd, mask, cookie, name_length = event_header.unpack_from(buffer, offset)
+        offset = offset + event_header.size
+
+        name = buffer[offset : offset + name_length].rstrip(b"\0")
+        offset = offset + name_length
+
+        if mask & IN_Q_OVERFLOW:
+            overflow = True
+            continue
+
+        if mask & IN_IGNORED:
+            watched_folders.pop(wd, None)
+            continue
+
+        if wd not in watched_folders or len(name) == 0:
+            continue
+
+        path = os.path.join(watched_folders[wd], os.fsdecode(name))
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                new_folders.append(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+            changed_paths.add(path)
+
+    return changed_paths, new_folders, overflow
+
+
+def watch(root, folders):
+    root = os.path.abspath(root)
+
+    fd = libc.inotify_init1(0)
+
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    started_at = time.time()
+    watched_folders = add_all_watches(fd, root, folders)
+    hash_manifest.save_watcher(root, os.getpid(), started_at)
+
+    heartbeat_at = time.time()
+
+    try:
+        while True:
+            readable, _, _ = select.select(
+                [fd], [], [], hash_manifest.watcher_heartbeat_seconds
+            )
+
+            if len(readable) > 0:
+                changed_paths, new_folders, overflow = read_events(
+                    fd, watched_folders
+                )
+
+                if overflow:
+                    logging.warning("Event queue overflowed, rescanning %s" % root)
+
+                    for wd in list(watched_folders.keys()):
+                        libc.inotify_rm_watch(fd, wd)
+
+                    watched_folders = add_all_watches(fd, root, folders)
+                    continue
+
+                for folder in new_folders:
+                    changed_paths.update(add_watches(fd, watched_folders, folder))
+
+                if len(changed_paths) > 0:
+                    hash_manifest.mark_dirty(root, changed_paths)
+
+            if time.time() - heartbeat_at >= hash_manifest.watcher_heartbeat_seconds:
+                hash_manifest.save_watcher(root, os.getpid(), started_at)
+                heartbeat_at = time.time()
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s",
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    if len(sys.argv) < 2:
+        print("usage: %s root_folder [folder...]" % sys.argv[0])
+        sys.exit(1)
+
+    watch(sys.argv[1], sys.argv[2:] if len(sys.argv) > 2 else ["en", "ja"])